@@ -0,0 +1,360 @@
+"""Mixed workload against the app: uploads, full and Range downloads, deep pagination, logins.
+
+Throwaway database and storage (the benchmark users and files are not removed):
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    export POSTGRES_HOST=127.0.0.1 POSTGRES_PORT=55432 POSTGRES_DB=storage_bench STORAGE_PATH=/tmp/storage_bench
+    mkdir -p $STORAGE_PATH && (cd src && alembic upgrade head)
+
+then either let the benchmark start gunicorn with the production profile (its RSS is reported):
+
+    python -m benchmarks.load --workers 2 --concurrency 32 --duration 30 --output results.json
+
+or point it to an app started otherwise (--server-pid: the process whose tree RSS is sampled):
+
+    python -m benchmarks.load --base-url http://127.0.0.1:8080 --server-pid 1234
+
+--mix sets the weights of the scenarios (upload_small=20,login=0...). Compare with the results of a previous run:
+
+    python -m benchmarks.load --workers 2 --baseline results.json --tolerance 0.2
+
+exits with 1 if the throughput of a scenario dropped or its p95 rose by more than the tolerance.
+The server loop lag comes from /metrics (upper bounds of the histogram buckets, all the workers);
+the client one is the lag of the load generator: if it is high, the client is the bottleneck.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks.stats import measure_lag, percentile
+from benchmarks.throughput import start_gunicorn, wait_ready
+
+PREFIX = '/api/v1'
+PASSWORD = 'Pa123ssword!'
+SCENARIOS = {'upload_small': 20, 'upload_large': 2, 'download_full': 15, 'download_range': 25,
+             'list_offset': 10, 'list_cursor': 15, 'login': 3}
+SEED_DIR = 'bench/list'
+LARGE_FILE = 'large.bin'
+BULK_BATCH = 200
+# Names reused by the uploads: they overwrite the files, the catalogue doesn't grow
+UPLOAD_NAMES = 100
+
+
+class User:
+    def __init__(self, username: str, token: str):
+        self.username = username
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.cursor: str | None = None
+
+
+class Workload:
+    def __init__(self, args: argparse.Namespace, client: httpx.AsyncClient, users: list[User]):
+        self.args = args
+        self.client = client
+        self.users = users
+        self.small = os.urandom(args.small_size_kb * 1024)
+        self.large = os.urandom(args.large_size_mb * 2 ** 20)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.bytes: dict[str, int] = defaultdict(int)
+
+    async def run_scenario(self, name: str, user: User) -> None:
+        start = time.perf_counter()
+        try:
+            size = await getattr(self, name)(user)
+            self.bytes[name] += size
+        except (httpx.HTTPError, KeyError, ValueError):
+            self.errors[name] += 1
+        self.latencies[name].append(time.perf_counter() - start)
+
+    async def _upload(self, user: User, content: bytes, name: str) -> int:
+        # A new content every time: the deduplicated storage would keep a single blob otherwise
+        content = os.urandom(16) + content
+        response = await self.client.post(f'{PREFIX}/files/upload', headers=user.headers,
+                                          params={'path_dir': 'bench/uploads'}, files={'file': (name, content)})
+        response.raise_for_status()
+        return len(content)
+
+    async def upload_small(self, user: User) -> int:
+        return await self._upload(user, self.small, f'small_{random.randrange(UPLOAD_NAMES)}.bin')
+
+    async def upload_large(self, user: User) -> int:
+        return await self._upload(user, self.large, f'large_{random.randrange(UPLOAD_NAMES)}.bin')
+
+    async def download_full(self, user: User) -> int:
+        return await self._download(user, {})
+
+    async def download_range(self, user: User) -> int:
+        length = self.args.range_size_kb * 1024
+        offset = random.randrange(max(1, len(self.large) - length))
+        return await self._download(user, {'Range': f'bytes={offset}-{offset + length - 1}'})
+
+    async def _download(self, user: User, headers: dict[str, str]) -> int:
+        size = 0
+        params = {'path_dir': 'bench', 'filename': LARGE_FILE}
+        async with self.client.stream('GET', f'{PREFIX}/files/download', headers=user.headers | headers,
+                                      params=params) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                size += len(chunk)
+        return size
+
+    async def list_offset(self, user: User) -> int:
+        """A page deep in the directory: the rows before it are scanned"""
+        limit = self.args.page_size
+        offset = random.randrange(max(1, self.args.seed_files - limit))
+        response = await self.client.get(f'{PREFIX}/files/', headers=user.headers,
+                                         params={'path_dir': SEED_DIR, 'limit': limit, 'offset': offset})
+        response.raise_for_status()
+        return len(response.content)
+
+    async def list_cursor(self, user: User) -> int:
+        """The next page of the user's walk through the directory (keyset pagination)"""
+        params = {'path_dir': SEED_DIR, 'limit': self.args.page_size}
+        if user.cursor:
+            params['cursor'] = user.cursor
+        response = await self.client.get(f'{PREFIX}/files/', headers=user.headers, params=params)
+        response.raise_for_status()
+        user.cursor = response.json().get('next_cursor')
+        return len(response.content)
+
+    async def login(self, user: User) -> int:
+        response = await self.client.post(f'{PREFIX}/auth', data={'username': user.username, 'password': PASSWORD})
+        response.raise_for_status()
+        return len(response.content)
+
+
+async def create_user(client: httpx.AsyncClient, run_id: str, i: int) -> User:
+    username = f'bench_{run_id}_{i}'
+    response = await client.post(f'{PREFIX}/register',
+                                 json={'username': username, 'password': PASSWORD, 'email': f'{username}@example.com'})
+    response.raise_for_status()
+    response = await client.post(f'{PREFIX}/auth', data={'username': username, 'password': PASSWORD})
+    response.raise_for_status()
+    return User(username, response.json()['access_token'])
+
+
+async def seed(client: httpx.AsyncClient, user: User, args: argparse.Namespace, large: bytes) -> None:
+    """The directory paginated by the list scenarios and the file downloaded"""
+    response = await client.post(f'{PREFIX}/files/upload', headers=user.headers, params={'path_dir': 'bench'},
+                                 files={'file': (LARGE_FILE, large)})
+    response.raise_for_status()
+    for start in range(0, args.seed_files, BULK_BATCH):
+        files = [('files', (f'file_{i:06}.txt', str(i).encode()))
+                 for i in range(start, min(start + BULK_BATCH, args.seed_files))]
+        response = await client.post(f'{PREFIX}/files/upload/bulk', headers=user.headers,
+                                     params={'path_dir': SEED_DIR}, files=files)
+        response.raise_for_status()
+
+
+def get_tree_rss(pid: int) -> int | None:
+    """RSS of the process and its descendants (gunicorn master and workers), bytes. Linux only"""
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) * 1024
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except (OSError, StopIteration):
+            # Exited meanwhile (a worker recycled), or no /proc
+            continue
+    return total or None
+
+
+async def sample_rss(pid: int, stop: asyncio.Event, interval: float) -> list[int]:
+    samples = []
+    while not stop.is_set():
+        rss = await asyncio.to_thread(get_tree_rss, pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(interval)
+    return samples
+
+
+async def scrape_loop_lag(client: httpx.AsyncClient) -> dict[str, float]:
+    """Cumulative buckets of event_loop_lag_seconds by 'le' and the blocks counter, empty without /metrics"""
+    response = await client.get('/metrics')
+    if response.status_code != 200:
+        return {}
+    samples = {}
+    for family in text_string_to_metric_families(response.text):
+        for sample in family.samples:
+            if sample.name == 'event_loop_lag_seconds_bucket':
+                samples[sample.labels['le']] = sample.value
+            elif sample.name == 'event_loop_blocks_total':
+                samples['blocks'] = sample.value
+    return samples
+
+
+def get_server_loop_lag(before: dict[str, float], after: dict[str, float]) -> dict | None:
+    """Lag during the run (the difference of the scrapes): p50 and p99 as bucket upper bounds, ms"""
+    buckets = sorted((float(le), after[le] - before.get(le, 0)) for le in after if le != 'blocks')
+    if not buckets or not buckets[-1][1]:
+        return None
+    total = buckets[-1][1]
+
+    def bucket_percentile(q: float) -> float:
+        return next(le for le, count in buckets if count >= q / 100 * total) * 1000
+
+    return dict(p50_le=bucket_percentile(50), p99_le=bucket_percentile(99),
+                blocks=after.get('blocks', 0) - before.get('blocks', 0))
+
+
+async def run(args: argparse.Namespace, base_url: str, server_pid: int | None) -> dict:
+    mix = SCENARIOS | {name: float(weight) for name, weight in
+                       (item.split('=') for item in args.mix.split(',') if item)}
+    unknown = set(mix) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+    names = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in names]
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        run_id = uuid.uuid4().hex[:8]
+        users = [await create_user(client, run_id, i) for i in range(args.users)]
+        workload = Workload(args, client, users)
+        await asyncio.gather(*(seed(client, user, args, workload.large) for user in users))
+
+        loop_lag_before = await scrape_loop_lag(client)
+        stop = asyncio.Event()
+        lag_monitor = asyncio.create_task(measure_lag(stop, 0.01))
+        rss_monitor = asyncio.create_task(sample_rss(server_pid, stop, 0.5)) if server_pid else None
+        deadline = time.perf_counter() + args.duration
+
+        async def virtual_user(user: User) -> None:
+            while time.perf_counter() < deadline:
+                await workload.run_scenario(random.choices(names, weights)[0], user)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(virtual_user(users[i % len(users)]) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        lags_ms = [lag * 1000 for lag in await lag_monitor]
+        rss = await rss_monitor if rss_monitor else []
+        server_loop_lag = get_server_loop_lag(loop_lag_before, await scrape_loop_lag(client))
+
+    scenarios = {}
+    for name in names:
+        latencies_ms = [latency * 1000 for latency in workload.latencies[name]]
+        scenarios[name] = dict(requests=len(latencies_ms), errors=workload.errors[name],
+                               rps=round(len(latencies_ms) / elapsed, 2),
+                               mib_per_s=round(workload.bytes[name] / elapsed / 2 ** 20, 2),
+                               p50_ms=round(percentile(latencies_ms, 50), 2),
+                               p95_ms=round(percentile(latencies_ms, 95), 2),
+                               p99_ms=round(percentile(latencies_ms, 99), 2))
+    return dict(
+        started_at=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        commit=get_commit(),
+        config={name: value for name, value in vars(args).items() if name not in ('output', 'baseline')},
+        duration_s=round(elapsed, 2),
+        total_rps=round(sum(len(latencies) for latencies in workload.latencies.values()) / elapsed, 2),
+        scenarios=scenarios,
+        server_loop_lag_ms=server_loop_lag,
+        client_loop_lag_ms=dict(p50=round(percentile(lags_ms, 50), 2), p99=round(percentile(lags_ms, 99), 2),
+                                max=round(percentile(lags_ms, 100), 2)),
+        server_rss_mib=dict(start=round(rss[0] / 2 ** 20, 1), peak=round(max(rss) / 2 ** 20, 1),
+                            end=round(rss[-1] / 2 ** 20, 1)) if rss else None,
+    )
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results: dict) -> None:
+    print(f'{results["duration_s"]} s, {results["total_rps"]} req/s, commit {results["commit"]}')
+    print(f'{"scenario":>15} {"req/s":>9} {"MiB/s":>8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"errors":>7}')
+    for name, stats in results['scenarios'].items():
+        print(f'{name:>15} {stats["rps"]:>9.1f} {stats["mib_per_s"]:>8.1f} {stats["p50_ms"]:>9.1f} '
+              f'{stats["p95_ms"]:>9.1f} {stats["p99_ms"]:>9.1f} {stats["errors"]:>7}')
+    if results['server_loop_lag_ms']:
+        lag = results['server_loop_lag_ms']
+        print(f'server loop lag ms: p50 <= {lag["p50_le"]}, p99 <= {lag["p99_le"]}, blocks {lag["blocks"]:.0f}')
+    lag = results['client_loop_lag_ms']
+    print(f'client loop lag ms: p50 {lag["p50"]}, p99 {lag["p99"]}, max {lag["max"]}')
+    if results['server_rss_mib']:
+        rss = results['server_rss_mib']
+        print(f'server RSS MiB: start {rss["start"]}, peak {rss["peak"]}, end {rss["end"]}')
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Regressions against the baseline: throughput lower or p95 higher by more than the tolerance"""
+    regressions = []
+    for name, stats in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if not base or not base['requests']:
+            continue
+        if stats['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f'{name}: {stats["rps"]} req/s, was {base["rps"]}')
+        if stats['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {stats["p95_ms"]} ms, was {base["p95_ms"]}')
+        if stats['errors'] > base['errors']:
+            regressions.append(f'{name}: {stats["errors"]} errors, was {base["errors"]}')
+    return regressions
+
+
+def main(args: argparse.Namespace) -> None:
+    process = None
+    base_url, server_pid = args.base_url, args.server_pid
+    if args.workers:
+        process = start_gunicorn(args.workers, args.port)
+        base_url, server_pid = f'http://127.0.0.1:{args.port}', process.pid
+    try:
+        if process:
+            wait_ready(base_url, process)
+        results = asyncio.run(run(args, base_url, server_pid))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    report(results)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:8080')
+    parser.add_argument('--server-pid', type=int, help='process of the app started otherwise, for its RSS')
+    parser.add_argument('--workers', type=int, default=0, help='start gunicorn with this number of workers')
+    parser.add_argument('--port', type=int, default=18081, help='of the gunicorn started')
+    parser.add_argument('--concurrency', type=int, default=32, help='virtual users (connections)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--users', type=int, default=4, help='accounts shared by the virtual users')
+    parser.add_argument('--mix', default='', help='scenario=weight,... over the defaults ' + str(SCENARIOS))
+    parser.add_argument('--seed-files', type=int, default=2000, help='files of the paginated directory, per user')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--small-size-kb', type=int, default=4)
+    parser.add_argument('--large-size-mb', type=int, default=16)
+    parser.add_argument('--range-size-kb', type=int, default=256)
+    parser.add_argument('--output', help='results as JSON')
+    parser.add_argument('--baseline', help='results JSON of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+"""/ping latency while the service is flooded with logins (bcrypt).
+
+Run against a started app (uvicorn or gunicorn, see web_start.sh):
+
+    python -m benchmarks.login_storm --base-url http://127.0.0.1:8080 --logins 400 --concurrency 100
+
+/ping p99 during the storm should stay close to the idle one: password hashing runs outside the event loop,
+logins beyond the hashing queue are rejected with 503 instead of piling up.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+from benchmarks.stats import percentile
+
+PREFIX = '/api/v1'
+
+
+async def ping_latencies(client: httpx.AsyncClient, stop: asyncio.Event, interval: float) -> list[float]:
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get(f'{PREFIX}/ping')
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def ping_for(client: httpx.AsyncClient, duration: float, interval: float) -> list[float]:
+    stop = asyncio.Event()
+    asyncio.get_running_loop().call_later(duration, stop.set)
+    return await ping_latencies(client, stop, interval)
+
+
+async def login_storm(client: httpx.AsyncClient, credentials: dict, logins: int, concurrency: int) -> Counter:
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = Counter()
+
+    async def login():
+        async with semaphore:
+            response = await client.post(f'{PREFIX}/auth', data=credentials)
+            statuses[response.status_code] += 1
+
+    await asyncio.gather(*(login() for _ in range(logins)))
+    return statuses
+
+
+def report(name: str, latencies: list[float]) -> None:
+    latencies_ms = [latency * 1000 for latency in latencies]
+    print(f'/ping {name:>6}: n={len(latencies_ms)}, p50 {percentile(latencies_ms, 50):.1f} ms, '
+          f'p99 {percentile(latencies_ms, 99):.1f} ms')
+
+
+async def main(args: argparse.Namespace) -> None:
+    username = f'bench_{uuid.uuid4().hex[:8]}'
+    credentials = dict(username=username, password='Pa123ssword!')
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60) as client:
+        response = await client.post(f'{PREFIX}/register', json=credentials | {'email': f'{username}@example.com'})
+        response.raise_for_status()
+
+        report('idle', await ping_for(client, args.idle_seconds, args.interval))
+
+        stop = asyncio.Event()
+        pinger = asyncio.create_task(ping_latencies(client, stop, args.interval))
+        start = time.perf_counter()
+        statuses = await login_storm(client, credentials, args.logins, args.concurrency)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        report('storm', await pinger)
+
+    print(f'logins: {args.logins / elapsed:.1f}/s, statuses: {dict(statuses)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:8080')
+    parser.add_argument('--logins', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--idle-seconds', type=float, default=3)
+    parser.add_argument('--interval', type=float, default=0.01, help='pause between /ping probes, s')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,78 @@
+"""Event-loop lag while many large downloads are streamed at once.
+
+Compares file_chunk_generator with a generator doing blocking open()/read() inside the loop.
+Run from the project root (the app settings are read from .env):
+
+    python -m benchmarks.loop_lag --files 8 --file-size-mb 32 --downloads 64
+
+For numbers close to production drop the page cache between the runs (echo 3 > /proc/sys/vm/drop_caches).
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from aiopath import AsyncPath
+
+from benchmarks.stats import measure_lag, percentile
+from src.core.config import app_settings
+from src.services.utils import file_chunk_generator
+
+
+async def blocking_chunk_generator(file_path: AsyncPath):
+    """The previous implementation: every read blocks the loop"""
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(app_settings.download_chunk_size):
+            yield chunk
+
+
+async def consume(chunks) -> int:
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        # Sending the chunk to the client
+        await asyncio.sleep(0)
+    return size
+
+
+async def run(generator, paths: list[AsyncPath], interval: float) -> tuple[float, int, list[float]]:
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(measure_lag(stop, interval))
+    start = time.perf_counter()
+    sizes = await asyncio.gather(*(consume(generator(path)) for path in paths))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, sum(sizes), await monitor
+
+
+def report(name: str, elapsed: float, size: int, lags: list[float]) -> None:
+    lags_ms = [lag * 1000 for lag in lags]
+    print(f'{name:>10}: {size / elapsed / 2 ** 20:8.1f} MiB/s | loop lag ms: '
+          f'p50 {percentile(lags_ms, 50):.2f}, p99 {percentile(lags_ms, 99):.2f}, max {percentile(lags_ms, 100):.2f}')
+
+
+async def main(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        files = []
+        for i in range(args.files):
+            path = Path(tmp_dir, f'file_{i}.bin')
+            with open(path, 'wb') as f:
+                for _ in range(args.file_size_mb):
+                    f.write(os.urandom(2 ** 20))
+            files.append(AsyncPath(path))
+        paths = [files[i % len(files)] for i in range(args.downloads)]
+
+        for name, generator in (('blocking', blocking_chunk_generator), ('aiofile', file_chunk_generator)):
+            report(name, *await run(generator, paths, args.interval))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--file-size-mb', type=int, default=32)
+    parser.add_argument('--downloads', type=int, default=64, help='number of concurrent downloads')
+    parser.add_argument('--interval', type=float, default=0.005, help='lag probe interval, s')
+    parser.add_argument('--dir', default=None, help='directory for the test files (the disk to measure)')
+    asyncio.run(main(parser.parse_args()))
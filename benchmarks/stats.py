@@ -0,0 +1,20 @@
+import asyncio
+import time
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile, q in [0, 100]"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+async def measure_lag(stop: asyncio.Event, interval: float) -> list[float]:
+    """Event-loop lag: how late the sleeps of interval seconds wake up, until stop is set"""
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+    return lags
@@ -0,0 +1,115 @@
+"""Throughput of the production profile (src/core/gunicorn_conf.py) by the number of worker processes.
+
+Starts gunicorn with each number of workers in turn and loads it from several client processes
+(a single Python client would be the bottleneck). Run from the project root (.env, the migrations applied):
+
+    python -m benchmarks.throughput --workers 1 2 4 --clients 4 --concurrency 32 --duration 10
+
+/ping is answered from the cached health check, so it measures the HTTP stack and the workers themselves;
+--path and --header point the load elsewhere (an authorized endpoint with 'Authorization: Bearer ...').
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.stats import percentile
+
+
+async def load(url: str, headers: dict[str, str], concurrency: int, duration: float) -> tuple[int, int, list[float]]:
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def user(client: httpx.AsyncClient) -> None:
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await client.get(url, headers=headers)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        await asyncio.gather(*(user(client) for _ in range(concurrency)))
+    return len(latencies), errors, latencies
+
+
+def run_client(args: tuple) -> tuple[int, int, list[float]]:
+    return asyncio.run(load(*args))
+
+
+def wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited')
+        try:
+            if httpx.get(f'{base_url}/api/v1/ping').status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError('gunicorn did not start')
+
+
+def start_gunicorn(workers: int, port: int) -> subprocess.Popen:
+    env = os.environ | {'WEB_WORKERS': str(workers), 'PROJECT_PORT': str(port), 'WEB_ACCESS_LOG': 'false'}
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'src/core/gunicorn_conf.py', 'src.main:app'],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def measure(args: argparse.Namespace, workers: int, headers: dict[str, str]) -> tuple[float, int, list[float]]:
+    process = start_gunicorn(workers, args.port)
+    base_url = f'http://127.0.0.1:{args.port}'
+    try:
+        wait_ready(base_url, process)
+        client_args = (base_url + args.path, headers, args.concurrency, args.duration)
+        with multiprocessing.get_context('spawn').Pool(args.clients) as pool:
+            start = time.perf_counter()
+            results = pool.map(run_client, [client_args] * args.clients)
+            elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+    requests = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    latencies = [latency for result in results for latency in result[2]]
+    return requests / elapsed, errors, latencies
+
+
+def main(args: argparse.Namespace) -> None:
+    headers = dict(header.split(': ', 1) for header in args.header)
+    baseline = None
+    print(f'{args.path}, {args.clients} clients x {args.concurrency} connections, {args.duration} s')
+    for workers in args.workers:
+        rps, errors, latencies = measure(args, workers, headers)
+        baseline = baseline or rps / workers
+        latencies_ms = [latency * 1000 for latency in latencies]
+        print(f'workers {workers:>3}: {rps:>9.0f} req/s, scaling {rps / baseline / workers:>4.0%}, '
+              f'p50 {percentile(latencies_ms, 50):.1f} ms, p99 {percentile(latencies_ms, 99):.1f} ms, '
+              f'errors {errors}')
+
+
+if __name__ == '__main__':
+    cpu_count = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # 1, 2, 4... up to the number of CPUs
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({min(2 ** i, cpu_count) for i in range(cpu_count.bit_length() + 1)}))
+    parser.add_argument('--clients', type=int, default=max(1, cpu_count // 2), help='load generating processes')
+    parser.add_argument('--concurrency', type=int, default=32, help='connections of a client process')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load for each number of workers')
+    parser.add_argument('--path', default='/api/v1/ping')
+    parser.add_argument('--header', action='append', default=[], help="'Name: value', repeatable")
+    parser.add_argument('--port', type=int, default=18080)
+    main(parser.parse_args())
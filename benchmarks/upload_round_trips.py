@@ -0,0 +1,92 @@
+"""Database round-trips per upload: the single upsert against the former check-then-write sequence.
+
+Both record the same uploads (new files, then overwrites of them) in the app database.
+Run from the project root (the app settings are read from .env, the migrations applied):
+
+    python -m benchmarks.upload_round_trips --uploads 200
+
+A round-trip is a statement, a BEGIN or a COMMIT: each waits for the answer of the server.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from pydantic import BaseModel
+from sqlalchemy import delete, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+
+from src.core.config import app_settings
+from src.models.file_model import File as FileModel
+from src.models.user_model import User as UserModel
+from src.schemas.file_schema import FileCreate, FileIn
+from src.services.file_service import FileRepository
+
+
+class SizeUpdate(BaseModel):
+    size: int
+    blob_hash: str | None = None
+
+
+async def check_then_write(db: AsyncSession, repo: FileRepository, obj_in: FileCreate) -> FileModel:
+    """The former sequence: SELECT the record, then UPDATE (or INSERT), COMMIT and the refresh SELECT"""
+    file_obj = await repo.get(db=db, db_obj=FileIn(name=obj_in.name, path_dir=obj_in.path_dir,
+                                                   user_id=obj_in.user_id))
+    if file_obj:
+        return await repo.update(db=db, db_obj=file_obj, obj_in=SizeUpdate(size=obj_in.size))
+    return await repo.create(db=db, obj_in=obj_in)
+
+
+async def upsert(db: AsyncSession, repo: FileRepository, obj_in: FileCreate) -> FileModel:
+    return await repo.save(db=db, obj_in=obj_in)
+
+
+class RoundTripCounter:
+    def __init__(self, engine):
+        self.count = 0
+        for name in ('before_cursor_execute', 'begin', 'commit', 'rollback'):
+            event.listen(engine.sync_engine, name, self.increment)
+
+    def increment(self, *args, **kwargs) -> None:
+        self.count += 1
+
+
+async def run(session_maker: async_sessionmaker, counter: RoundTripCounter, save, user_id: uuid.UUID,
+              uploads: int) -> None:
+    repo = FileRepository()
+    for phase in ('create', 'overwrite'):
+        counter.count = 0
+        start = time.perf_counter()
+        async with session_maker() as db:
+            for i in range(uploads):
+                obj_in = FileCreate(name=f'{save.__name__}_{i}.txt', path_dir='bench', size=i, user_id=user_id)
+                await save(db, repo, obj_in)
+        elapsed = time.perf_counter() - start
+        print(f'{save.__name__:>16} {phase:>9}: {counter.count / uploads:.1f} round-trips/upload, '
+              f'{elapsed / uploads * 1000:.2f} ms/upload')
+
+
+async def main(args: argparse.Namespace) -> None:
+    engine = create_async_engine(app_settings.database_dsn)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    user_id = uuid.uuid4()
+    async with session_maker() as db:
+        db.add(UserModel(id=user_id, username=f'bench_{user_id.hex[:8]}', hashed_password=user_id.hex,
+                         email=f'bench_{user_id.hex[:8]}@example.com'))
+        await db.commit()
+    counter = RoundTripCounter(engine)
+    try:
+        for save in (check_then_write, upsert):
+            await run(session_maker, counter, save, user_id, args.uploads)
+    finally:
+        async with session_maker() as db:
+            # The files go with the user (cascade)
+            await db.execute(delete(UserModel).where(UserModel.id == user_id))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uploads', type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
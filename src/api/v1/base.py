@@ -1,7 +1,11 @@
+import asyncio
+
 from fastapi import APIRouter
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST
 
 from src.core.config import app_settings
+from src.services.metrics import generate_metrics
 
 router = APIRouter()
 
@@ -14,3 +18,14 @@ TAG_FILE = 'File'
 @router.get('/', description='Redirect to doc page', include_in_schema=False, tags=[TAG_SERVICE])
 async def root_handler():
     return RedirectResponse(app_settings.docs_url)
+
+
+async def get_metrics() -> Response:
+    """Prometheus metrics of all the worker processes"""
+    content = await asyncio.to_thread(generate_metrics)
+    return Response(content=content, headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+# Not found when the metrics are off
+if app_settings.metrics_enabled:
+    router.add_api_route('/metrics', get_metrics, methods=['GET'], tags=[TAG_SERVICE])
@@ -1,10 +1,11 @@
-from typing import Any, Annotated, Type
+from typing import Any, Annotated, Type, Literal
+from uuid import UUID
 
-from fastapi import APIRouter, Depends, status, UploadFile, File, HTTPException, Query
+from fastapi import APIRouter, Depends, status, UploadFile, File, HTTPException, Query, Header, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 
-from src.core.config import PaginationParams
+from src.core.config import app_settings, PaginationParams, FileFilterParams
 from src.db.db import get_session
 from src.models.file_model import File as FileModel
 from src.schemas.file_schema import FileOut, FileInfo
@@ -28,6 +29,44 @@ async def upload_file(
     return file_model_obj
 
 
+# The form is parsed by the endpoint: up to bulk_upload_max_files files, not the 1000 of starlette's default
+BULK_UPLOAD_BODY = {'requestBody': {'required': True, 'content': {'multipart/form-data': {'schema': {
+    'type': 'object', 'required': ['files'],
+    'properties': {'files': {'type': 'array', 'items': {'type': 'string', 'format': 'binary'}}}}}}}}
+
+
+@router.post('/upload/bulk', response_model=list[FileOut], status_code=status.HTTP_201_CREATED, tags=[TAG_FILE],
+             openapi_extra=BULK_UPLOAD_BODY)
+async def upload_files(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        request: Request,
+        path_dir: str | None = None
+) -> list[FileModel]:
+    """Many files in one request (the parts of the form), all put in path_dir"""
+    async with request.form(max_files=app_settings.bulk_upload_max_files) as form:
+        files = [file for file in form.getlist('files') if not isinstance(file, str)]
+        if not files:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='No files provided')
+        file_model_objs = await file_service.upload_files(db=db, user=current_user, files=files, path_dir=path_dir)
+    return file_model_objs
+
+
+@router.post('/upload/tar', response_model=list[FileOut], status_code=status.HTTP_201_CREATED, tags=[TAG_FILE])
+async def upload_tar(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        request: Request,
+        path_dir: str | None = None
+) -> list[FileModel]:
+    """The body is an uncompressed tar archive (application/x-tar): its files are put in path_dir by their paths"""
+    file_model_objs = await file_service.upload_tar(db=db, user=current_user, chunks=request.stream(),
+                                                    path_dir=path_dir)
+    return file_model_objs
+
+
 @router.get('/download', tags=[TAG_FILE])
 async def download_file(
         *,
@@ -35,7 +74,9 @@ async def download_file(
         current_user: Annotated[UserInDB, Depends(get_current_active_user)],
         filename: Annotated[str | None, Query(min_length=1)] = None,
         path_dir: str | None = None,
-        file_id: str | None = None
+        file_id: str | None = None,
+        range_header: Annotated[str | None, Header(alias='Range')] = None,
+        if_range: Annotated[str | None, Header(alias='If-Range')] = None
 ) -> Type[Response]:
     if not filename and not file_id:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='No path or file_id provided')
@@ -43,17 +84,62 @@ async def download_file(
                                                 user=current_user,
                                                 filename=filename,
                                                 path_dir=path_dir,
-                                                file_id=file_id
+                                                file_id=file_id,
+                                                range_header=range_header,
+                                                if_range=if_range
                                                 )
     return response
 
 
+@router.get('/download-archive', tags=[TAG_FILE])
+async def download_archive(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        path_dir: str | None = None,
+        file_id: Annotated[list[UUID] | None, Query()] = None,
+        archive_format: Annotated[Literal['zip', 'tar'], Query(alias='format')] = 'zip',
+        compression: Literal['store', 'deflate'] = 'deflate'
+) -> StreamingResponse:
+    """The files of path_dir (with its subdirectories) or the listed ones as a ZIP or TAR archive, streamed.
+    compression is for ZIP"""
+    if path_dir is None and not file_id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='No path or file_id provided')
+    response = await file_service.download_archive(db=db,
+                                                   user=current_user,
+                                                   path_dir=path_dir,
+                                                   file_ids=file_id,
+                                                   archive_format=archive_format,
+                                                   compression=compression)
+    return response
+
+
 @router.get('/', response_model=FileInfo, tags=[TAG_FILE])
 async def get_info(
         *,
         db: AsyncSession = Depends(get_session),
         current_user: Annotated[UserInDB, Depends(get_current_active_user)],
         page_params: Annotated[PaginationParams, Depends(PaginationParams)],
+        filter_params: Annotated[FileFilterParams, Depends(FileFilterParams)],
 ) -> dict[str, Any]:
-    file_list = await file_service.get_list_info(db=db, user_id=current_user.id, page_params=page_params)
+    file_list = await file_service.get_list_info(db=db,
+                                                 user_id=current_user.id,
+                                                 page_params=page_params,
+                                                 filter_params=filter_params)
     return file_list
+
+
+@router.get('/export', tags=[TAG_FILE])
+async def export_files(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        filter_params: Annotated[FileFilterParams, Depends(FileFilterParams)],
+        export_format: Annotated[Literal['ndjson', 'csv'], Query(alias='format')] = 'ndjson',
+) -> StreamingResponse:
+    """The whole catalogue of the user's files (NDJSON or CSV), streamed"""
+    response = await file_service.export_files(db=db,
+                                               user_id=current_user.id,
+                                               filter_params=filter_params,
+                                               export_format=export_format)
+    return response
@@ -1,11 +1,11 @@
-from typing import Annotated
+from typing import Annotated, Any
 
 from fastapi import APIRouter, Depends, status
 from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.db.db import get_session
-from src.services.health_service import health_service
+from src.services.health_service import health_service, SUCCESS, ERROR
 from .base import TAG_SERVICE
 
 router = APIRouter()
@@ -16,8 +16,34 @@ async def get_ping(
         *,
         db: Annotated[AsyncSession, Depends(get_session)],
 ) -> ORJSONResponse:
-    """Database health check"""
+    """Database health check (the result of the last /health probes)"""
     data: dict[str, str] = await health_service.get_ping(db=db)
-    is_time = data['info'][0].isdigit()
-    status_code = status.HTTP_200_OK if is_time else status.HTTP_503_SERVICE_UNAVAILABLE
+    status_code = status.HTTP_200_OK if data['status'] == SUCCESS else status.HTTP_503_SERVICE_UNAVAILABLE
     return ORJSONResponse(content=data, status_code=status_code)
+
+
+@router.get('/health', tags=[TAG_SERVICE])
+async def get_health(
+        *,
+        db: Annotated[AsyncSession, Depends(get_session)],
+) -> ORJSONResponse:
+    """Database, storage and connection pool checks: 503 if one of them fails, 'degraded' is still 200.
+    The probes run at most once per health_cache_ttl seconds in a worker process"""
+    data = await health_service.get_health(db=db)
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE if data['status'] == ERROR else status.HTTP_200_OK
+    return ORJSONResponse(content=data, status_code=status_code)
+
+
+@router.get('/cache', tags=[TAG_SERVICE])
+async def get_cache_stats() -> dict[str, dict[str, int]]:
+    """Hit/miss counters of the in-process caches (of the worker process that served the request).
+    Not served by the public server (nginx), like /metrics"""
+    return await health_service.get_cache_stats()
+
+
+@router.get('/pool', tags=[TAG_SERVICE])
+async def get_pool_stats() -> dict[str, Any]:
+    """Database connection pool of the worker process that served the request: connections checked out
+    and opened over the pool size, checkouts, the ones timed out and the time waited for a connection (s).
+    Not served by the public server (nginx), like /metrics"""
+    return await health_service.get_pool_stats()
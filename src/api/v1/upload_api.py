@@ -0,0 +1,151 @@
+from typing import Any, Annotated
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, status, Query, Header, Request, Path
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.responses import Response
+
+from src.db.db import get_session
+from src.schemas.file_schema import FileOut
+from src.models.file_model import File as FileModel
+from src.schemas.upload_schema import UploadSessionOut, UploadPartOut, MultipartUploadComplete
+from src.schemas.user_schema import UserInDB
+from src.services.auth import get_current_active_user
+from src.services.upload_service import upload_service, MAX_PARTS
+from .base import TAG_FILE
+
+router = APIRouter()
+
+
+@router.post('/', response_model=UploadSessionOut, status_code=status.HTTP_201_CREATED, tags=[TAG_FILE])
+async def create_upload(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        request: Request,
+        response: Response,
+        filename: Annotated[str, Query(min_length=1)],
+        path_dir: str | None = None,
+        upload_length: Annotated[int, Header(alias='Upload-Length', ge=0)]
+) -> dict[str, Any]:
+    """Start a resumable upload of upload_length bytes: the content is sent by PATCH to the Location"""
+    upload_state = await upload_service.create_upload(db=db,
+                                                      user=current_user,
+                                                      filename=filename,
+                                                      path_dir=path_dir,
+                                                      length=upload_length)
+    response.headers.update(upload_service.get_headers(upload_state))
+    response.headers['Location'] = str(request.url_for('get_upload_offset',
+                                                       upload_id=upload_state.upload_session.id))
+    return upload_service.get_info(upload_state)
+
+
+@router.post('/multipart', response_model=UploadSessionOut, status_code=status.HTTP_201_CREATED, tags=[TAG_FILE])
+async def create_multipart_upload(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        filename: Annotated[str, Query(min_length=1)],
+        path_dir: str | None = None
+) -> dict[str, Any]:
+    """Start a multipart upload: the parts are sent in parallel, then the upload is completed with their list"""
+    upload_state = await upload_service.create_multipart_upload(db=db,
+                                                                user=current_user,
+                                                                filename=filename,
+                                                                path_dir=path_dir)
+    return upload_service.get_info(upload_state)
+
+
+@router.put('/multipart/{upload_id}/parts/{part_number}', response_model=UploadPartOut, tags=[TAG_FILE])
+async def upload_part(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        request: Request,
+        upload_id: UUID,
+        part_number: Annotated[int, Path(ge=1, le=MAX_PARTS)],
+        part_sha256: Annotated[str | None, Header(alias='X-Content-SHA256')] = None
+) -> dict[str, Any]:
+    """The body is the part. Its sha256 (hex) is checked if sent, it is returned to be listed on completion"""
+    part = await upload_service.write_part(db=db,
+                                           user=current_user,
+                                           upload_id=upload_id,
+                                           part_number=part_number,
+                                           chunks=request.stream(),
+                                           sha256=part_sha256)
+    return part._asdict()
+
+
+@router.get('/multipart/{upload_id}/parts', response_model=list[UploadPartOut], tags=[TAG_FILE])
+async def get_parts(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        upload_id: UUID
+) -> list[dict[str, Any]]:
+    parts = await upload_service.get_parts(db=db, user=current_user, upload_id=upload_id)
+    return [part._asdict() for part in parts]
+
+
+@router.post('/multipart/{upload_id}/complete', response_model=FileOut, tags=[TAG_FILE])
+async def complete_multipart_upload(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        upload_id: UUID,
+        upload_complete: MultipartUploadComplete
+) -> FileModel:
+    """Join the listed parts into the file"""
+    upload_state = await upload_service.complete_multipart_upload(db=db,
+                                                                  user=current_user,
+                                                                  upload_id=upload_id,
+                                                                  parts=upload_complete.parts)
+    return upload_state.file
+
+
+@router.head('/{upload_id}', tags=[TAG_FILE])
+async def get_upload_offset(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        upload_id: UUID
+) -> Response:
+    """Upload-Offset: the number of bytes received, the upload is resumed from it"""
+    upload_state = await upload_service.get_upload(db=db, user=current_user, upload_id=upload_id)
+    return Response(headers=upload_service.get_headers(upload_state))
+
+
+@router.patch('/{upload_id}', status_code=status.HTTP_204_NO_CONTENT, tags=[TAG_FILE],
+              responses={status.HTTP_200_OK: {'model': FileOut, 'description': 'The upload is complete'}})
+async def write_upload(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        request: Request,
+        upload_id: UUID,
+        upload_offset: Annotated[int, Header(alias='Upload-Offset', ge=0)]
+) -> Response:
+    """The body (application/offset+octet-stream) is written at upload_offset.
+    The last chunk creates the file and returns it"""
+    upload_state = await upload_service.write_upload(db=db,
+                                                     user=current_user,
+                                                     upload_id=upload_id,
+                                                     offset=upload_offset,
+                                                     chunks=request.stream())
+    headers = upload_service.get_headers(upload_state)
+    if upload_state.file is None:
+        return Response(status_code=status.HTTP_204_NO_CONTENT, headers=headers)
+    return ORJSONResponse(content=FileOut.model_validate(upload_state.file).model_dump(mode='json'), headers=headers)
+
+
+@router.delete('/{upload_id}', status_code=status.HTTP_204_NO_CONTENT, tags=[TAG_FILE])
+async def delete_upload(
+        *,
+        db: AsyncSession = Depends(get_session),
+        current_user: Annotated[UserInDB, Depends(get_current_active_user)],
+        upload_id: UUID
+) -> Response:
+    """Cancel the upload (resumable or multipart)"""
+    await upload_service.delete_upload(db=db, user=current_user, upload_id=upload_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -1,4 +1,7 @@
 import pathlib
+import tempfile
+from datetime import datetime
+from typing import Literal
 
 from pydantic import BaseModel, PostgresDsn, DirectoryPath, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -10,6 +13,21 @@ ENV_PATH = pathlib.Path(BASE_DIR.parent, '.env')
 class PaginationParams(BaseModel):
     limit: int = 10
     offset: int = 0
+    # next_cursor of the previous page, the offset is ignored if it is set
+    cursor: str | None = None
+
+
+class FileFilterParams(BaseModel):
+    # Files of the directory and of all its subdirectories
+    path_dir: str | None = None
+    # False - only the files right in path_dir, its subdirectories are listed in common_prefixes
+    recursive: bool = True
+    name_prefix: str | None = None
+    min_size: int | None = None
+    max_size: int | None = None
+    modified_since: datetime | None = None
+    sort: Literal['path', 'name', 'size', 'updated_at'] = 'path'
+    order: Literal['asc', 'desc'] = 'asc'
 
 
 class AppPostgresSettings(BaseSettings):
@@ -39,21 +57,142 @@ class AppSettings(BaseSettings):
 
     app_title: str = "File Storage"
     database_dsn: str = str(AppPostgresSettings().dsn)
+    # Log every statement (debugging only: it costs CPU and I/O)
+    db_echo: bool = False
+    # Connections of a worker process: up to db_pool_size kept open plus db_max_overflow opened on demand.
+    # A request waits db_pool_timeout seconds for one. Connections are reopened after db_pool_recycle seconds
+    # (-1 - never), tested before the checkout if db_pool_pre_ping (one more round-trip)
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = -1
+    db_pool_pre_ping: bool = False
+    # Prepared statements cached per connection (0 - none, needed behind pgbouncer in transaction mode)
+    db_statement_cache_size: int = 100
+    db_connect_timeout: float = 10
 
     project_host: str = ...
     project_port: int = ...
+    # gunicorn (src/core/gunicorn_conf.py): worker processes (0 - one per CPU), the queue of the connections
+    # not accepted yet, seconds an idle keep-alive connection is kept. A worker is restarted after
+    # web_max_requests requests (+ random up to the jitter, 0 - never), given web_graceful_timeout seconds
+    # to finish its requests on a restart and killed if it doesn't answer the master for web_timeout seconds
+    web_workers: int = 0
+    web_backlog: int = 2048
+    web_keepalive: int = 5
+    web_max_requests: int = 10000
+    web_max_requests_jitter: int = 1000
+    web_graceful_timeout: int = 30
+    web_timeout: int = 60
+    # Import the app in the master before forking the workers
+    web_preload: bool = True
+    # Proxies trusted with X-Forwarded-For / X-Forwarded-Proto (nginx)
+    web_forwarded_allow_ips: str = '*'
+    web_access_log: bool = False
+    # Development server (python main.py) reloaded on code changes
+    web_reload: bool = False
+    # Prometheus metrics (/metrics): request latencies and bytes, database statements
+    metrics_enabled: bool = True
+    # gunicorn workers write their metrics here, it is emptied on the start
+    metrics_multiprocess_dir: pathlib.Path = pathlib.Path(tempfile.gettempdir(), 'storage_metrics')
+    # Request tracing: the spans (service, repository, auth calls) of the requests slower than trace_slow_request
+    # seconds are logged. The control file (JSON: enabled, slow_request, profiler, profile_sample_rate)
+    # overrides these settings while the app runs
+    trace_enabled: bool = False
+    trace_slow_request: float = 1.0
+    # A share of the traced requests is profiled as well, the slow ones are written to trace_dir.
+    # 'pyinstrument' is not in the requirements: install it to use it
+    trace_profiler: Literal['none', 'cprofile', 'pyinstrument'] = 'none'
+    trace_profile_sample_rate: float = 0.1
+    trace_control_file: pathlib.Path = pathlib.Path(BASE_DIR.parent, 'tracing.json')
+    trace_dir: pathlib.Path = pathlib.Path(tempfile.gettempdir(), 'storage_traces')
+    # Event-loop watchdog of a worker: the lag is measured every loop_monitor_interval seconds, the stack of
+    # a blocking call holding the loop longer than loop_monitor_threshold seconds is logged
+    loop_monitor_enabled: bool = True
+    loop_monitor_interval: float = 0.1
+    loop_monitor_threshold: float = 0.25
+    # Tests only (LOOP_MONITOR_STRICT_MS=100 pytest): a test blocking the loop longer fails. 0 - off
+    loop_monitor_strict_ms: int = 0
 
     prefix: str = '/api/v1'
     docs_url: str = '/api/openapi'
     openapi_url: str = '/api/openapi.json'
 
     large_file_size: int = 1024 * 1024
-
+    # Rows fetched from the server-side cursor at a time by the catalogue export
+    export_batch_size: int = 1000
+    download_chunk_size: int = 200 * 1024
+    # Number of chunks read in advance while the current one is being sent
+    download_read_ahead: int = 1
+    upload_chunk_size: int = 1024 * 1024
+    # none - no fsync, file - fsync the temp file before the rename, full - also fsync the directory after it
+    upload_durability: Literal['none', 'file', 'full'] = 'file'
+    # Resumable uploads: up to upload_max_size bytes, the session expires upload_session_ttl seconds
+    # after the last write, the expired ones are removed every upload_cleanup_interval seconds (0 - never)
+    upload_max_size: int = 64 * 1024 ** 3
+    upload_session_ttl: float = 24 * 3600
+    upload_cleanup_interval: float = 600
+    # Bulk uploads: up to bulk_upload_max_files files a request, bulk_upload_concurrency of them written at once.
+    # A tar archive is up to bulk_upload_max_size bytes (client_max_body_size of nginx/sites-available/nginx.temp)
+    bulk_upload_max_files: int = 10000
+    bulk_upload_max_size: int = 16 * 1024 ** 3
+    bulk_upload_concurrency: int = 8
+    # Archive downloads: up to archive_max_files files in one archive
+    archive_max_files: int = 10000
+
+    # local - files in storage_path, s3 - objects in a bucket of an S3-compatible storage (shared by the app hosts)
+    storage_backend: Literal['local', 's3'] = 'local'
     storage_path: DirectoryPath = pathlib.Path(BASE_DIR.parent, 'storage')
+    s3_endpoint_url: str = 'http://localhost:9000'
+    s3_bucket: str = 'storage'
+    s3_region: str = 'us-east-1'
+    s3_access_key: str = ''
+    s3_secret_key: str = ''
+    # Keys of the objects start with it (several apps in a bucket)
+    s3_prefix: str = ''
+    # Larger uploads are sent as multipart uploads (parts of at least 5 MiB), s3_upload_concurrency parts at once
+    s3_part_size: int = 8 * 1024 * 1024
+    s3_upload_concurrency: int = 4
+    s3_max_connections: int = 64
+    s3_timeout: float = 30
+    # Deduplicated storage: the content of the uploads is kept once per sha256 in storage_path/.blobs
+    dedup_storage: bool = False
+    # Blobs no file points to are removed every blob_gc_interval seconds (0 - never),
+    # if they have not been used for blob_gc_grace seconds
+    blob_gc_interval: float = 3600
+    blob_gc_grace: float = 3600
+    blob_gc_batch_size: int = 1000
+
+    # stream - the app sends the file itself, accel - nginx sends it (X-Accel-Redirect) after the app checks access
+    download_mode: Literal['stream', 'accel'] = 'stream'
+    # nginx 'internal' location serving storage_path
+    accel_redirect_location: str = '/protected-storage/'
 
     token_expire_minutes: int = 60
     token_secret_key: str = Field(..., alias='SECRET_KEY')
     token_jwt_algorithm: str = 'HS256'
 
+    # Authenticated users and decoded tokens are cached in the worker process (ttl in seconds, 0 - no cache).
+    # A change of a user invalidates the cache of the worker that made it only: the other workers can serve
+    # the old user (e.g. still active) for up to user_cache_ttl seconds
+    user_cache_size: int = 1024
+    user_cache_ttl: float = 30
+    token_cache_size: int = 4096
+    token_cache_ttl: float = 300
+
+    # bcrypt runs in a thread pool (it releases the GIL) of password_hash_workers threads,
+    # calls beyond password_hash_queue_size waiting ones are rejected with 503
+    password_hash_workers: int = 2
+    password_hash_queue_size: int = 32
+    password_hash_rounds: int = 12
+
+    # Health checks: the probes run at once, each up to health_probe_timeout seconds, the result is reused
+    # for health_cache_ttl seconds. Free space below health_min_free_space or the share of the checked out
+    # pool connections above health_pool_saturation make the service 'degraded'
+    health_probe_timeout: float = 2
+    health_cache_ttl: float = 5
+    health_min_free_space: int = 1024 ** 3
+    health_pool_saturation: float = 0.9
+
 
 app_settings = AppSettings()
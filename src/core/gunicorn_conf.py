@@ -0,0 +1,47 @@
+"""gunicorn settings of the production profile, taken from AppSettings (.env / environment):
+
+    gunicorn -c src/core/gunicorn_conf.py src.main:app
+"""
+import multiprocessing
+import os
+import shutil
+
+from src.core.config import app_settings
+
+# prometheus_client multiprocess mode: set before the app (and prometheus_client) is imported.
+# Emptied on the start only, not on a reload (HUP), as the running workers keep their files
+if app_settings.metrics_enabled and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    shutil.rmtree(app_settings.metrics_multiprocess_dir, ignore_errors=True)
+    app_settings.metrics_multiprocess_dir.mkdir(parents=True)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = str(app_settings.metrics_multiprocess_dir)
+
+bind = f'{app_settings.project_host}:{app_settings.project_port}'
+worker_class = 'src.core.workers.UvicornWorker'
+workers = app_settings.web_workers or multiprocessing.cpu_count()
+backlog = app_settings.web_backlog
+keepalive = app_settings.web_keepalive
+# A worker is restarted after max_requests (+ up to the jitter, so they don't restart at once) requests:
+# whatever leaks is released
+max_requests = app_settings.web_max_requests
+max_requests_jitter = app_settings.web_max_requests_jitter
+timeout = app_settings.web_timeout
+graceful_timeout = app_settings.web_graceful_timeout
+# The app is imported once in the master, the workers share its memory (copy-on-write) and start faster
+preload_app = app_settings.web_preload
+forwarded_allow_ips = app_settings.web_forwarded_allow_ips
+accesslog = '-' if app_settings.web_access_log else None
+
+
+def post_fork(server, worker):
+    # With preload_app the engine is created in the master: the worker must not reuse its connections
+    # (there are none before the first request, dispose makes sure). close=False leaves them to the master
+    from src.db.db import engine
+
+    engine.sync_engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    # The gauges of the live workers only
+    from src.services.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
@@ -0,0 +1,8 @@
+from uvicorn.workers import UvicornWorker as BaseUvicornWorker
+
+
+class UvicornWorker(BaseUvicornWorker):
+    """uvicorn worker of gunicorn with the fast event loop and HTTP parser required, not just used if installed:
+    a missing one fails the start instead of slowing the service down silently"""
+
+    CONFIG_KWARGS = {'loop': 'uvloop', 'http': 'httptools', 'lifespan': 'on'}
@@ -1,12 +1,126 @@
+import logging
+import time
+from typing import Any
+
+from fastapi import Request
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from src.core.config import app_settings
 
-engine = create_async_engine(app_settings.database_dsn, echo=True, future=True)
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """Connection pool counting the checkouts and the time the requests wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait_time = time.perf_counter() - start
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.checkouts += 1
+        return connection
+
+    def stats(self) -> dict[str, Any]:
+        # Connections of this worker process: workers * capacity has to stay below the max_connections of Postgres
+        return dict(size=self.size(),
+                    capacity=self.size() + max(self._max_overflow, 0),
+                    checked_out=self.checkedout(),
+                    # SQLAlchemy counts it from -size
+                    overflow=max(self.overflow(), 0),
+                    checkouts=self.checkouts,
+                    timeouts=self.timeouts,
+                    wait_time=round(self.wait_time, 6),
+                    max_wait_time=round(self.max_wait_time, 6))
+
+
+engine = create_async_engine(
+    app_settings.database_dsn,
+    echo=app_settings.db_echo,
+    future=True,
+    poolclass=MeteredQueuePool,
+    pool_size=app_settings.db_pool_size,
+    max_overflow=app_settings.db_max_overflow,
+    pool_timeout=app_settings.db_pool_timeout,
+    pool_recycle=app_settings.db_pool_recycle,
+    pool_pre_ping=app_settings.db_pool_pre_ping,
+    connect_args=dict(
+        # Prepared statements cached by SQLAlchemy and by asyncpg (0 for pgbouncer in transaction mode)
+        prepared_statement_cache_size=app_settings.db_statement_cache_size,
+        statement_cache_size=app_settings.db_statement_cache_size,
+        timeout=app_settings.db_connect_timeout,
+    ),
+)
 async_session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 
-async def get_session() -> AsyncSession:
+# Sessions of the request in its ASGI scope, closed when the response starts
+SCOPE_SESSIONS = 'db_sessions'
+# session.info key of the sessions the response body still reads from
+KEEP_OPEN = 'keep_open'
+
+
+async def get_session(request: Request) -> AsyncSession:
+    """Session of the request. It checks out a connection on its first statement only (nothing for the requests
+    answered from the caches) and gives it back when the response starts, before the body is sent"""
+
     async with async_session() as session:
+        track_session(request, session)
         yield session
+
+
+def track_session(request: Request, session: AsyncSession) -> None:
+    sessions = request.scope.get(SCOPE_SESSIONS)
+    if sessions is not None:
+        sessions.append(session)
+
+
+def keep_session_open(session: AsyncSession) -> None:
+    """The response body is read from the session (a server-side cursor): it stays open until the body is sent"""
+
+    session.info[KEEP_OPEN] = True
+
+
+class SessionReleaseMiddleware:
+    """Closes the sessions of the request as the response starts: their connections go back to the pool
+    instead of staying checked out while the body is streamed (a large download to a slow client).
+    The dependency closes them again afterwards, which does nothing"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        sessions: list[AsyncSession] = []
+        scope[SCOPE_SESSIONS] = sessions
+
+        async def send_releasing(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                for session in sessions:
+                    if session.info.get(KEEP_OPEN):
+                        continue
+                    try:
+                        await session.close()
+                    except Exception:
+                        logging.exception('Session not closed before the response')
+            await send(message)
+
+        await self.app(scope, receive, send_releasing)
@@ -15,3 +15,38 @@ class ValidationException(HTTPException):
     def __init__(self, item):
         self.item = item
         super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=f'Invalid {item}')
+
+
+class ServiceOverloadedException(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail='Service is overloaded, try again later',
+                         headers={'Retry-After': '1'})
+
+
+class RangeNotSatisfiableException(HTTPException):
+    def __init__(self, file_size: int):
+        super().__init__(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                         detail='Requested range not satisfiable',
+                         headers={'Content-Range': f'bytes */{file_size}'})
+
+
+class StorageUnavailableException(HTTPException):
+    def __init__(self, reason: str):
+        super().__init__(status_code=status.HTTP_502_BAD_GATEWAY, detail=f'Storage is unavailable: {reason}')
+
+
+class UploadNotFoundException(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_404_NOT_FOUND, detail='Upload not found')
+
+
+class UploadConflictException(HTTPException):
+    def __init__(self, reason: str):
+        super().__init__(status_code=status.HTTP_409_CONFLICT, detail=reason)
+
+
+class UploadTooLargeException(HTTPException):
+    def __init__(self, max_size: int):
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail=f'Upload is larger than {max_size} bytes')
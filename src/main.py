@@ -1,9 +1,45 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from fastapi.responses import ORJSONResponse
 
-from src.api.v1 import base, user_api, health_api, file_api
+from src.api.v1 import base, user_api, health_api, file_api, upload_api
 from src.core.config import app_settings
+from src.db.db import SessionReleaseMiddleware, engine
+from src.services.background import run_periodically
+from src.services.blob_service import blob_service
+from src.services.loop_monitor import LoopMonitor
+from src.services.metrics import MetricsMiddleware, instrument_engine
+from src.services.storage import storage_backends
+from src.services.tracing import TracingMiddleware
+from src.services.upload_service import upload_service
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Background tasks of the worker, cancelled on shutdown
+    background_tasks = []
+    if app_settings.blob_gc_interval > 0:
+        background_tasks.append(asyncio.create_task(
+            run_periodically(blob_service.collect_garbage, app_settings.blob_gc_interval, 'Blob garbage collection')))
+    if app_settings.upload_cleanup_interval > 0:
+        background_tasks.append(asyncio.create_task(
+            run_periodically(upload_service.remove_expired, app_settings.upload_cleanup_interval,
+                             'Expired uploads cleanup')))
+    loop_monitor = LoopMonitor() if app_settings.loop_monitor_enabled else None
+    if loop_monitor:
+        loop_monitor.start()
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if loop_monitor:
+        await loop_monitor.stop()
+    for storage in storage_backends.values():
+        await storage.close()
+
 
 app = FastAPI(
     # The name of the project to be displayed in the documentation
@@ -15,17 +51,30 @@ app = FastAPI(
     # If the JSON-serializer is not explicitly specified in the response,
     # the faster 'ORJSONResponse' will be used instead of the standard 'JSONResponse'
     default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
+app.add_middleware(SessionReleaseMiddleware)
+# Always in: the tracing is turned on and off at runtime
+app.add_middleware(TracingMiddleware)
+if app_settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+    instrument_engine(engine)
+
 app.include_router(base.router)
 app.include_router(user_api.router, prefix=app_settings.prefix)
 app.include_router(health_api.router, prefix=app_settings.prefix)
 app.include_router(file_api.router, prefix=app_settings.prefix + '/files')
+app.include_router(upload_api.router, prefix=app_settings.prefix + '/files/uploads')
 
 if __name__ == '__main__':
     uvicorn.run(
         'main:app',
         host=app_settings.project_host,
         port=app_settings.project_port,
-        reload=True,
+        reload=app_settings.web_reload,
+        loop='uvloop',
+        http='httptools',
+        backlog=app_settings.web_backlog,
+        timeout_keep_alive=app_settings.web_keepalive,
     )
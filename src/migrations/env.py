@@ -10,7 +10,9 @@ from alembic import context
 from core.config import app_settings
 from models.base import Base
 from models.user_model import User
+from models.blob_model import Blob
 from models.file_model import File
+from models.upload_model import UploadSession
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
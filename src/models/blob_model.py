@@ -0,0 +1,19 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, func
+
+from .base import Base
+
+
+class Blob(Base):
+    """Content of the files stored once per sha256 (deduplicated storage)"""
+
+    __tablename__ = 'blob'
+
+    hash = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    # Number of the file rows pointing to the blob, kept by the trigger on the 'file' table
+    ref_count = Column(Integer, nullable=False, server_default='0')
+    created_at = Column(DateTime, server_default=func.now())
+    last_used_at = Column(DateTime, server_default=func.now())
+
+    def __repr__(self):
+        return f'Blob({self.hash[:12]}|{self.size}|refs:{self.ref_count})'
@@ -1,8 +1,10 @@
 import uuid
 
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, UUID, UniqueConstraint, func
+from sqlalchemy import (Column, BigInteger, String, Boolean, DateTime, ForeignKey, UUID, UniqueConstraint, Index, DDL,
+                        event, func)
 
 from .base import Base
+from .blob_model import Blob
 from .user_model import User
 
 
@@ -14,11 +16,46 @@ class File(Base):
     path_dir = Column(String(200), nullable=False)
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
-    size = Column(Integer, nullable=False)
+    size = Column(BigInteger, nullable=False)
     is_downloadable = Column(Boolean, default=True, nullable=False)
     user_id = Column(UUID, ForeignKey(User.id, ondelete='CASCADE'), nullable=False, )
+    # Set if the content is in the deduplicated storage
+    blob_hash = Column(String(64), ForeignKey(Blob.hash), nullable=True, index=True)
 
     UniqueConstraint(name, path_dir, user_id, name='user_file_path')
+    # Listing of the user's files in the (path_dir, name) order
+    Index('ix_file_user_id_path_dir_name', user_id, path_dir, name)
+    # Prefix search on path_dir and name (text_pattern_ops: independent of the database collation)
+    Index('ix_file_user_id_path_dir_pattern', user_id, path_dir, postgresql_ops={'path_dir': 'text_pattern_ops'})
+    Index('ix_file_user_id_name_pattern', user_id, name, postgresql_ops={'name': 'text_pattern_ops'})
+    # Filters and listing by name, size and modification time
+    Index('ix_file_user_id_name', user_id, name, path_dir)
+    Index('ix_file_user_id_size', user_id, size, path_dir, name)
+    Index('ix_file_user_id_updated_at', user_id, updated_at, path_dir, name)
 
     def __repr__(self):
         return f'File({str(self.id)[:5]}|{self.name}|{self.updated_at}|{self.size}|user:{str(self.user_id)[:5]})'
+
+
+# blob.ref_count follows the file rows whatever changes them (single and bulk statements, cascade deletes).
+# The migration '04_create_blob_table' creates the same from its own copy: a change here needs a new migration
+BLOB_REF_COUNT_FUNCTION = DDL('''
+CREATE OR REPLACE FUNCTION file_blob_ref_count() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.blob_hash IS NOT NULL THEN
+        UPDATE blob SET ref_count = ref_count - 1 WHERE hash = OLD.blob_hash;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.blob_hash IS NOT NULL THEN
+        UPDATE blob SET ref_count = ref_count + 1 WHERE hash = NEW.blob_hash;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+''')
+BLOB_REF_COUNT_TRIGGER = DDL('''
+CREATE TRIGGER file_blob_ref_count AFTER INSERT OR DELETE OR UPDATE OF blob_hash ON file
+FOR EACH ROW EXECUTE FUNCTION file_blob_ref_count()
+''')
+
+event.listen(File.__table__, 'after_create', BLOB_REF_COUNT_FUNCTION.execute_if(dialect='postgresql'))
+event.listen(File.__table__, 'after_create', BLOB_REF_COUNT_TRIGGER.execute_if(dialect='postgresql'))
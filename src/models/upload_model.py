@@ -0,0 +1,27 @@
+import uuid
+
+from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, UUID, func
+
+from .base import Base
+from .user_model import User
+
+
+class UploadSession(Base):
+    """resumable - the content is written to a staging file until it has 'length' bytes,
+    multipart - the numbered parts are staged separately (in parallel) and joined on completion"""
+
+    __tablename__ = 'upload_session'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(UUID(as_uuid=True), ForeignKey(User.id, ondelete='CASCADE'), nullable=False, index=True)
+    name = Column(String(100), nullable=False)
+    path_dir = Column(String(200), nullable=False)
+    kind = Column(String(20), nullable=False, server_default='resumable')
+    # Unknown for the multipart uploads until they are completed
+    length = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    # The session expires upload_session_ttl seconds after the last write
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now(), index=True)
+
+    def __repr__(self):
+        return f'UploadSession({str(self.id)[:5]}|{self.name}|{self.length}|user:{str(self.user_id)[:5]})'
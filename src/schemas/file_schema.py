@@ -13,6 +13,7 @@ class FileBase(BaseModel):
 
 class FileCreate(FileBase):
     user_id: UUID
+    blob_hash: str | None = None
 
 
 class FileInDB(FileBase):
@@ -30,10 +31,6 @@ class FileOut(FileBase):
     is_downloadable: bool
 
 
-class FileUpdateSize(BaseModel):
-    size: int
-
-
 class FileIn(BaseModel):
     name: str
     path_dir: str
@@ -47,3 +44,6 @@ class FileID(BaseModel):
 class FileInfo(BaseModel):
     user_id: UUID
     files: list[FileOut]
+    next_cursor: str | None = None
+    # Subdirectories of path_dir (non-recursive listing)
+    common_prefixes: list[str] = []
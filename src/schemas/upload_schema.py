@@ -0,0 +1,43 @@
+from datetime import datetime
+from typing import Literal
+from uuid import UUID
+
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class UploadSessionCreate(BaseModel):
+    name: str
+    path_dir: str
+    kind: Literal['resumable', 'multipart'] = 'resumable'
+    length: int | None
+    user_id: UUID
+
+
+class UploadSessionID(BaseModel):
+    id: UUID
+
+
+class UploadSessionOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: UUID
+    name: str
+    path_dir: str
+    kind: str
+    length: int | None
+    offset: int
+    expires_at: datetime
+
+
+class UploadPartOut(BaseModel):
+    part_number: int
+    size: int
+    sha256: str
+
+
+class UploadPartIn(BaseModel):
+    part_number: int = Field(ge=1)
+    sha256: str
+
+
+class MultipartUploadComplete(BaseModel):
+    parts: list[UploadPartIn] = Field(min_length=1)
@@ -1,4 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from uuid import UUID
+
+from pydantic import BaseModel, EmailStr, ConfigDict
 
 
 class BaseUser(BaseModel):
@@ -23,3 +25,12 @@ class UserInDB(BaseModel):
     email: EmailStr
     hashed_password: bytes
     is_active: bool | None = True
+
+
+class UserCached(UserInDB):
+    model_config = ConfigDict(from_attributes=True)
+    id: UUID
+
+
+class UserActivity(BaseModel):
+    is_active: bool
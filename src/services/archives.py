@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import posixpath
+import tarfile
+import zipfile
+from datetime import datetime, timezone
+from typing import AsyncIterator, BinaryIO, NamedTuple
+
+from fastapi import UploadFile
+
+from src.core.config import app_settings
+from src.exceptions import ValidationException
+from src.services.storage import StorageBackend
+from src.services.utils import FileUpload
+
+ARCHIVE_MEDIA_TYPES = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+ZIP_COMPRESSIONS = {'store': zipfile.ZIP_STORED, 'deflate': zipfile.ZIP_DEFLATED}
+
+
+class ArchiveEntry(NamedTuple):
+    name: str
+    key: str
+    size: int
+    # UTC without a timezone, as stored
+    modified_at: datetime
+
+
+class StreamBuffer:
+    """Write-only (unseekable) file object: it collects the bytes written by the archive writers
+    until the generator drains them"""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self._chunks.append(bytes(data))
+            self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+class FileRange:
+    """Read-only view of the bytes [offset, offset + size) of an open file. The views don't share a position
+    (pread), so the members of one archive are read concurrently"""
+
+    def __init__(self, fd: int, offset: int, size: int):
+        self.fd = fd
+        self.position = offset
+        self.end = offset + size
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.end - self.position:
+            size = self.end - self.position
+        data = os.pread(self.fd, size, self.position)
+        self.position += len(data)
+        return data
+
+    def close(self) -> None:
+        pass
+
+
+def get_member_path(name: str, path_dir: str) -> tuple[str, str]:
+    """(path_dir, filename) of the archive member (or the part of a bulk upload form) put under path_dir.
+    The names leaving it, or naming no file, are rejected"""
+
+    path = posixpath.normpath(name)
+    if path.startswith('/') or path in ('.', '..') or path.startswith('../'):
+        raise ValidationException(f'file name: {name}')
+    member_dir, filename = posixpath.split(path)
+    return '/'.join(part for part in (path_dir.rstrip('/'), member_dir) if part), filename
+
+
+def read_tar_members(f: BinaryIO, path_dir: str, max_members: int) -> list[FileUpload]:
+    """Regular files of the uncompressed tar archive in f (a real file: its fd is read by the members).
+    Nothing is extracted, the uploads read the data of the members in place"""
+
+    members = []
+    try:
+        with tarfile.open(fileobj=f, mode='r:') as tar:
+            for member in tar:
+                if not member.isreg() or member.issparse():
+                    continue
+                if len(members) == max_members:
+                    raise ValidationException(f'number of files (max {max_members})')
+                member_dir, filename = get_member_path(member.name, path_dir)
+                file = UploadFile(FileRange(f.fileno(), member.offset_data, member.size),
+                                  size=member.size, filename=filename)
+                members.append(FileUpload(path_dir=member_dir, filename=filename, file=file))
+    except tarfile.TarError as e:
+        raise ValidationException(f'tar archive: {e}')
+    return members
+
+
+async def _read_entry(storage: StorageBackend, entry: ArchiveEntry) -> AsyncIterator[bytes]:
+    """Content of the entry, its size is checked (it is in the archive headers)"""
+
+    size = 0
+    async for chunk in storage.read(entry.key):
+        size += len(chunk)
+        yield chunk
+    if size != entry.size:
+        logging.error(f'{entry.key}: {size} bytes instead of {entry.size}')
+        raise RuntimeError(f'Size of {entry.name} changed')
+
+
+async def tar_stream_generator(storage: StorageBackend, entries: list[ArchiveEntry]) -> AsyncIterator[bytes]:
+    """Tar archive of the entries generated while it is sent: the contents are read from the storage
+    chunk by chunk, the small pieces (headers, padding) are sent together with the data"""
+
+    chunk_size = app_settings.download_chunk_size
+    buffer = StreamBuffer()
+    offset = 0
+    for entry in entries:
+        tar_info = tarfile.TarInfo(entry.name)
+        tar_info.size = entry.size
+        tar_info.mtime = int(entry.modified_at.replace(tzinfo=timezone.utc).timestamp())
+        offset += buffer.write(tar_info.tobuf(tarfile.PAX_FORMAT))
+        async for chunk in _read_entry(storage, entry):
+            offset += buffer.write(chunk)
+            if buffer.size >= chunk_size:
+                yield buffer.drain()
+        offset += buffer.write(bytes(-offset % tarfile.BLOCKSIZE))
+    # The end of the archive, padded to a whole record as tar does
+    offset += buffer.write(bytes(2 * tarfile.BLOCKSIZE))
+    buffer.write(bytes(-offset % tarfile.RECORDSIZE))
+    yield buffer.drain()
+
+
+async def zip_stream_generator(storage: StorageBackend, entries: list[ArchiveEntry],
+                               compression: int) -> AsyncIterator[bytes]:
+    """ZIP archive of the entries generated while it is sent. zipfile writes to the unseekable buffer:
+    the sizes and CRC follow the data (data descriptors), ZIP64 is used for the large files"""
+
+    chunk_size = app_settings.download_chunk_size
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=compression) as zip_file:
+        for entry in entries:
+            zip_info = zipfile.ZipInfo(entry.name, date_time=entry.modified_at.timetuple()[:6])
+            zip_info.compress_type = compression
+            zip_info.external_attr = 0o100644 << 16
+            # Only to choose ZIP64 for the entry
+            zip_info.file_size = entry.size
+            with zip_file.open(zip_info, mode='w') as f:
+                async for chunk in _read_entry(storage, entry):
+                    if compression == zipfile.ZIP_STORED:
+                        f.write(chunk)
+                    else:
+                        # zlib releases the GIL
+                        await asyncio.to_thread(f.write, chunk)
+                    if buffer.size >= chunk_size:
+                        yield buffer.drain()
+    yield buffer.drain()
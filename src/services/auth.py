@@ -1,3 +1,4 @@
+import time
 from typing import Annotated
 
 from fastapi import Depends, HTTPException, status
@@ -8,27 +9,41 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from src.core.config import app_settings
 from src.db.db import get_session
 from src.schemas.token_schema import oauth2_scheme
-from src.schemas.user_schema import Username, UserInDB
+from src.schemas.user_schema import Username, UserInDB, UserCached
+from src.services.cache import TTLCache
+from src.services.tracing import Span, traced
 from src.services.user_service import user_service
 
+# Username from the token, kept no longer than the token is valid
+token_cache: TTLCache[str, str] = TTLCache('token', app_settings.token_cache_size, app_settings.token_cache_ttl)
 
+
+@traced
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
-                           db: Annotated[AsyncSession, Depends(get_session)]):
+                           db: Annotated[AsyncSession, Depends(get_session)]) -> UserCached:
     authenticate_value = "Bearer"
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": authenticate_value},
     )
-    try:
-        payload = jwt.decode(token, app_settings.token_secret_key, algorithms=app_settings.token_jwt_algorithm)
-        username: str = payload.get("sub")
-        if username is None:
+    username = token_cache.get(token)
+    if username is None:
+        try:
+            with Span('jwt.decode'):
+                payload = jwt.decode(token, app_settings.token_secret_key,
+                                     algorithms=app_settings.token_jwt_algorithm)
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except (JWTError, ValidationError):
             raise credentials_exception
-    except (JWTError, ValidationError):
-        raise credentials_exception
+        token_cache.set(token, username, ttl=payload.get('exp', float('inf')) - time.time())
     username_obj = Username(username=username)
-    user = await user_service.get_user(db=db, username=username_obj)
+    user = await user_service.get_cached_user(db=db, username=username_obj)
+    if db.in_transaction():
+        # Read from the database: end the transaction, the connection is not held while the request body comes
+        await db.commit()
     if user is None:
         raise credentials_exception
     return user
@@ -0,0 +1,20 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.db.db import async_session
+
+
+async def run_periodically(job: Callable[[AsyncSession], Awaitable[int]], interval: float, name: str) -> None:
+    """Background task of the app: job(db) every interval seconds, the job returns the number of removed items"""
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with async_session() as db:
+                removed = await job(db)
+            logging.info(f'{name}: {removed} removed')
+        except Exception:
+            logging.exception(f'{name} failed')
@@ -1,14 +1,21 @@
 import logging
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Generic, List, Optional, TypeVar
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Generic, List, Optional, TypeVar
+from uuid import UUID
 
 from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from sqlalchemy import and_, func, update
+from sqlalchemy import and_, update, tuple_, RowMapping
+from sqlalchemy.dialects.postgresql import Insert, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.orm import InstrumentedAttribute
+from sqlalchemy.sql.elements import ColumnElement
 
+from src.exceptions import ValidationException
 from src.models.base import Base
+from src.services.tracing import Span, traced
 
 
 class Repository(ABC):
@@ -24,6 +31,14 @@ class Repository(ABC):
     async def create_multi(self, *args, **kwargs):
         raise NotImplementedError
 
+    @abstractmethod
+    async def upsert(self, *args, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upsert_multi(self, *args, **kwargs):
+        raise NotImplementedError
+
     @abstractmethod
     async def get(self, *args, **kwargs):
         raise NotImplementedError
@@ -32,10 +47,22 @@ class Repository(ABC):
     async def get_multi(self, *args, **kwargs):
         raise NotImplementedError
 
+    @abstractmethod
+    async def get_multi_keyset(self, *args, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_multi(self, *args, **kwargs):
+        raise NotImplementedError
+
     @abstractmethod
     async def update(self, *args, **kwargs):
         raise NotImplementedError
 
+    @abstractmethod
+    async def delete(self, *args, **kwargs):
+        raise NotImplementedError
+
 
 ModelType = TypeVar('ModelType', bound=Base)
 DBFieldsType = TypeVar('DBFieldsType', bound=BaseModel)
@@ -46,32 +73,71 @@ UpdateSchemaType = TypeVar('UpdateSchemaType', bound=BaseModel)
 class SQLAlchemyRepository(Repository, Generic[ModelType, DBFieldsType, CreateSchemaType, UpdateSchemaType]):
     model = None
 
+    @traced
     async def check_db_health(self, db: AsyncSession) -> bool:
         try:
-            stmt = select(self.model)
-            result = await db.execute(statement=stmt)
-            return bool(result)
+            # Constant cost whatever the tables are
+            result = await db.execute(statement=select(1))
+            return result.scalar_one() == 1
         except Exception as e:
             logging.error(e)
             return False
 
+    @traced
     async def create(self, db: AsyncSession, obj_in: CreateSchemaType) -> ModelType:
         obj_in_data = jsonable_encoder(obj_in)
         db_obj = self.model(**obj_in_data)
         db.add(db_obj)
-        await db.commit()
-        await db.refresh(db_obj)
+        with Span('commit'):
+            await db.commit()
+        with Span('refresh'):
+            await db.refresh(db_obj)
         return db_obj
 
+    @traced
     async def create_multi(self, db: AsyncSession, obj_in_list: List[CreateSchemaType]) -> List[ModelType]:
         obj_data = jsonable_encoder(obj_in_list)
         db_objs = [self.model(**obj) for obj in obj_data]
         db.add_all(db_objs)
-        await db.commit()
-        for obj in db_objs:
-            await db.refresh(obj)
+        with Span('commit'):
+            await db.commit()
+        with Span('refresh'):
+            for obj in db_objs:
+                await db.refresh(obj)
         return db_objs
 
+    @traced
+    async def upsert(self, db: AsyncSession, obj_in: CreateSchemaType, constraint: str,
+                     update_fields: list[str], **values: Any) -> ModelType:
+        """Insert the row or update update_fields (and the values) of the one conflicting on the unique constraint.
+        A single INSERT ... ON CONFLICT DO UPDATE ... RETURNING: no check before, no refresh after,
+        concurrent upserts of the same row don't fail"""
+
+        stmt = self._upsert_statement(constraint, update_fields, values).values(**obj_in.model_dump())
+        results = await db.scalars(stmt.returning(self.model), execution_options={'populate_existing': True})
+        db_obj = results.one()
+        with Span('commit'):
+            await db.commit()
+        return db_obj
+
+    @traced
+    async def upsert_multi(self, db: AsyncSession, obj_in_list: List[CreateSchemaType], constraint: str,
+                           update_fields: list[str], **values: Any) -> List[ModelType]:
+        """upsert of many rows. One statement (in pages of executemany), the rows come back by RETURNING
+        in the order of obj_in_list instead of being refreshed one by one"""
+
+        if not obj_in_list:
+            return []
+        stmt = self._upsert_statement(constraint, update_fields, values)
+        stmt = stmt.returning(self.model, sort_by_parameter_order=True)
+        results = await db.scalars(stmt, [obj_in.model_dump() for obj_in in obj_in_list],
+                                   execution_options={'populate_existing': True})
+        db_objs = results.all()
+        with Span('commit'):
+            await db.commit()
+        return db_objs
+
+    @traced
     async def get(self, db: AsyncSession, db_obj: DBFieldsType) -> Optional[ModelType]:
         db_obj = db_obj.model_dump()
         conditions = [getattr(self.model, k) == v for k, v in db_obj.items()]
@@ -79,17 +145,94 @@ class SQLAlchemyRepository(Repository, Generic[ModelType, DBFieldsType, CreateSc
         result = await db.execute(statement=stmt)
         return result.scalar_one_or_none()
 
-    async def get_multi(self, db: AsyncSession, obj: dict, limit: int, offset: int) -> list[ModelType]:
-        conditions = [getattr(self.model, k) == v for k, v in obj.items()]
-        stmt = select(self.model).where(and_(*conditions)).offset(offset).limit(limit)
+    @traced
+    async def get_multi(self, db: AsyncSession, obj: dict, limit: int, offset: int,
+                        order_by: list[str] | None = None, descending: bool = False,
+                        filters: list[ColumnElement[bool]] | None = None) -> list[ModelType]:
+        conditions = [getattr(self.model, k) == v for k, v in obj.items()] + (filters or [])
+        order_columns = [getattr(self.model, name) for name in order_by or []]
+        if descending:
+            order_columns = [column.desc() for column in order_columns]
+        stmt = select(self.model).where(and_(*conditions)).order_by(*order_columns).offset(offset).limit(limit)
         results = await db.execute(statement=stmt)
         return results.scalars().all()
 
+    @traced
+    async def get_multi_keyset(self, db: AsyncSession, obj: dict, limit: int, order_by: list[str],
+                               after: list | None = None, descending: bool = False,
+                               filters: list[ColumnElement[bool]] | None = None) -> list[ModelType]:
+        """Page of rows following the `after` values of the order_by columns (unique together).
+        Unlike the offset, the rows before the page are not scanned"""
+
+        conditions = [getattr(self.model, k) == v for k, v in obj.items()] + (filters or [])
+        order_columns = [getattr(self.model, name) for name in order_by]
+        if after is not None:
+            after = [self._from_json(column, value) for column, value in zip(order_columns, after)]
+            if descending:
+                conditions.append(tuple_(*order_columns) < tuple_(*after))
+            else:
+                conditions.append(tuple_(*order_columns) > tuple_(*after))
+        if descending:
+            order_columns = [column.desc() for column in order_columns]
+        stmt = select(self.model).where(and_(*conditions)).order_by(*order_columns).limit(limit)
+        results = await db.execute(statement=stmt)
+        return results.scalars().all()
+
+    async def stream_multi(self, db: AsyncSession, obj: dict, columns: list[str], batch_size: int,
+                           order_by: list[str] | None = None,
+                           filters: list[ColumnElement[bool]] | None = None) -> AsyncIterator[list[RowMapping]]:
+        """Batches of the column values read through a server-side cursor: memory use doesn't depend
+        on the number of rows"""
+
+        conditions = [getattr(self.model, k) == v for k, v in obj.items()] + (filters or [])
+        stmt = (select(*[getattr(self.model, name) for name in columns])
+                .where(and_(*conditions))
+                .order_by(*[getattr(self.model, name) for name in order_by or []])
+                .execution_options(yield_per=batch_size))
+        results = await db.stream(statement=stmt)
+        async for rows in results.mappings().partitions():
+            yield rows
+
+    @traced
     async def update(self, db: AsyncSession, db_obj: ModelType, obj_in: UpdateSchemaType | Dict[str, Any]
                      ) -> Optional[ModelType]:
         obj_in = obj_in.model_dump()
         stmt = update(self.model).where(self.model.id == str(db_obj.id)).values(**obj_in)
         await db.execute(stmt)
-        await db.commit()
-        await db.refresh(db_obj)
+        with Span('commit'):
+            await db.commit()
+        with Span('refresh'):
+            await db.refresh(db_obj)
         return db_obj
+
+    @traced
+    async def delete(self, db: AsyncSession, db_obj: ModelType) -> None:
+        await db.delete(db_obj)
+        with Span('commit'):
+            await db.commit()
+
+    def _upsert_statement(self, constraint: str, update_fields: list[str], values: dict[str, Any]) -> Insert:
+        stmt = insert(self.model)
+        return stmt.on_conflict_do_update(constraint=constraint,
+                                          set_={name: stmt.excluded[name] for name in update_fields} | values)
+
+    @staticmethod
+    def _from_json(column: InstrumentedAttribute, value: Any) -> Any:
+        """Column value from its JSON form (keyset cursors are JSON). The cursors come from the clients:
+        a value the column can't be compared with is a ValidationException, not an error of the database"""
+
+        python_type = column.type.python_type
+        try:
+            if isinstance(value, str) and python_type is datetime:
+                value = datetime.fromisoformat(value)
+                if (value.tzinfo is not None) != column.type.timezone:
+                    raise ValueError(value)
+            elif isinstance(value, str) and python_type is UUID:
+                value = UUID(value)
+        except ValueError:
+            raise ValidationException('cursor')
+        if (not isinstance(value, python_type) or isinstance(value, bool) != (python_type is bool)
+                or isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63
+                or isinstance(value, str) and '\x00' in value):
+            raise ValidationException('cursor')
+        return value
@@ -0,0 +1,83 @@
+import logging
+from datetime import timedelta
+from typing import Type
+
+from sqlalchemy import delete, func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.core.config import app_settings
+from src.models.blob_model import Blob as BlobModel
+from src.services.base_service import SQLAlchemyRepository, Repository
+from src.services.storage import StagedFile, get_storage
+from src.services.utils import get_blob_key
+
+
+class BlobRepository(SQLAlchemyRepository):
+    model = BlobModel
+
+    async def acquire(self, db: AsyncSession, blob_hash: str, size: int) -> bool:
+        """Insert the blob or mark the existing one as just used. True if the blob is new"""
+
+        stmt = (insert(self.model)
+                .values(hash=blob_hash, size=size)
+                .on_conflict_do_update(index_elements=[self.model.hash], set_={'last_used_at': func.now()})
+                # xmax is 0 for the inserted row and the locking transaction id for the updated one
+                .returning(literal_column('xmax = 0')))
+        result = await db.execute(statement=stmt)
+        is_new = result.scalar_one()
+        await db.commit()
+        return is_new
+
+    async def delete_unreferenced(self, db: AsyncSession, grace: timedelta, limit: int) -> list[str]:
+        """Delete (without a commit) the blobs no file points to and not used within the grace period.
+        The rows locked by the other collectors are skipped"""
+
+        unreferenced = (select(self.model.hash)
+                        .where(self.model.ref_count <= 0, self.model.last_used_at < func.now() - grace)
+                        .limit(limit)
+                        .with_for_update(skip_locked=True))
+        stmt = delete(self.model).where(self.model.hash.in_(unreferenced)).returning(self.model.hash)
+        results = await db.execute(statement=stmt)
+        return list(results.scalars())
+
+
+class BlobService:
+    def __init__(self, repo: Type[Repository]):
+        self.repo = repo()
+
+    async def store(self, db: AsyncSession, staged_file: StagedFile) -> str:
+        """Commit the staged upload to the storage unless the same content is already there.
+        Returns the hash of the blob"""
+
+        storage = get_storage()
+        blob_hash = staged_file.checksum
+        blob_key = get_blob_key(blob_hash)
+        is_new = await self.repo.acquire(db, blob_hash, staged_file.size)
+        # A row left without its file (a crash between the commit and the rename) is repaired by the same content
+        if is_new or not await storage.exists(blob_key):
+            await storage.commit(staged_file, blob_key)
+        else:
+            await storage.discard(staged_file)
+            logging.info(f'Blob {blob_hash} is already stored')
+        return blob_hash
+
+    async def collect_garbage(self, db: AsyncSession) -> int:
+        """Remove the unreferenced blobs, returns their number"""
+
+        storage = get_storage()
+        grace = timedelta(seconds=app_settings.blob_gc_grace)
+        batch_size = app_settings.blob_gc_batch_size
+        removed = 0
+        while True:
+            blob_hashes = await self.repo.delete_unreferenced(db, grace, batch_size)
+            # The files are removed while the rows are locked, so nobody can acquire the blobs meanwhile
+            for blob_hash in blob_hashes:
+                await storage.delete(get_blob_key(blob_hash))
+            await db.commit()
+            removed += len(blob_hashes)
+            if len(blob_hashes) < batch_size:
+                return removed
+
+
+blob_service = BlobService(BlobRepository)
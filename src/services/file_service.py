@@ -1,102 +1,466 @@
+import asyncio
 import logging
-from typing import Type, Any
-from uuid import UUID
+import posixpath
+import tempfile
+from typing import Type, Any, Callable, Awaitable, AsyncIterator
+from urllib.parse import quote
+from uuid import UUID, uuid4
 
-from aiopath import AsyncPath
-from fastapi import UploadFile
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import UploadFile, status
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from sqlalchemy import String, Select, and_, or_, func, select, text
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute
+from sqlalchemy.sql.elements import ColumnElement
 
-from src.core.config import PaginationParams, app_settings
-from src.exceptions import FileNotFoundException, ValidationException
+from src.core.config import PaginationParams, FileFilterParams, app_settings
+from src.db.db import keep_session_open
+from src.exceptions import FileNotFoundException, UploadTooLargeException, ValidationException
 from src.models.file_model import File as FileModel
-from src.schemas.file_schema import FileCreate, FileUpdateSize, FileIn, FileInDB, FileID
+from src.schemas.file_schema import FileCreate, FileIn, FileInDB, FileID
 from src.schemas.user_schema import UserInDB
+from src.services.archives import (ARCHIVE_MEDIA_TYPES, ZIP_COMPRESSIONS, ArchiveEntry, get_member_path,
+                                   read_tar_members, tar_stream_generator, zip_stream_generator)
 from src.services.base_service import SQLAlchemyRepository, Repository
-from src.services.utils import get_absolute_file_path, write_file, file_chunk_generator
+from src.services.blob_service import blob_service
+from src.services.http_ranges import (RANGE_UNIT, get_etag, get_last_modified, is_range_fresh, parse_range_header,
+                                      get_content_range, get_multipart_length, multipart_byteranges_generator)
+from src.services.storage import StorageBackend, StagedFile, get_storage
+from src.services.tracing import traced
+from src.services.utils import (FileUpload, as_utc, get_content_disposition, get_file_key, get_blob_key, encode_cursor,
+                                decode_cursor, ndjson_batch_generator, csv_batch_generator)
+
+OCTET_STREAM = 'application/octet-stream'
+# Files are listed in these orders, the columns are unique for the user together (keyset pagination)
+LIST_ORDERS = {
+    'path': ['path_dir', 'name'],
+    'name': ['name', 'path_dir'],
+    'size': ['size', 'path_dir', 'name'],
+    'updated_at': ['updated_at', 'path_dir', 'name'],
+}
+
+
+# Fields of the exported files
+EXPORT_COLUMNS = list(FileInDB.model_fields)
+# A file uploaded to the path of an existing one overwrites it
+SAVE_UPSERT = dict(constraint='user_file_path', update_fields=['size', 'blob_hash'], updated_at=func.now())
 
 
 class FileRepository(SQLAlchemyRepository):
     model = FileModel
 
+    def get_filters(self, filter_params: FileFilterParams) -> list[ColumnElement[bool]]:
+        filters = []
+        path_dir = (filter_params.path_dir or '').rstrip('/')
+        if not filter_params.recursive:
+            filters.append(self.model.path_dir == path_dir)
+        elif path_dir:
+            filters.append(or_(self.model.path_dir == path_dir,
+                               self._starts_with(self.model.path_dir, path_dir + '/')))
+        if filter_params.name_prefix:
+            filters.append(self._starts_with(self.model.name, filter_params.name_prefix))
+        if filter_params.min_size is not None:
+            filters.append(self.model.size >= filter_params.min_size)
+        if filter_params.max_size is not None:
+            filters.append(self.model.size <= filter_params.max_size)
+        if filter_params.modified_since is not None:
+            filters.append(self.model.updated_at >= as_utc(filter_params.modified_since).replace(tzinfo=None))
+        return filters
+
+    @traced
+    async def get_subdirectories(self, db: AsyncSession, user_id: UUID, path_dir: str) -> list[str]:
+        """Immediate subdirectories of path_dir having files (in any depth). A loose index scan: a lookup
+        in the (user_id, path_dir) pattern index per subdirectory, not a read of all the rows below path_dir"""
+
+        path_dir = path_dir.rstrip('/')
+        prefix = f'{path_dir}/' if path_dir else ''
+        path = self.model.path_dir
+        # The rows below path_dir: [prefix, upper bound) in the order of the pattern index (bytewise)
+        below = [self.model.user_id == user_id]
+        if path_dir:
+            below.append(path.op('~<~', is_comparison=True)(path_dir + '0'))
+
+        def first_path(*conditions: ColumnElement[bool]) -> Select:
+            return select(path).where(*below, *conditions).order_by(text('path_dir USING ~<~')).limit(1)
+
+        def subdirectory(column: ColumnElement[str]) -> ColumnElement[str]:
+            return func.split_part(func.substr(column, len(prefix) + 1), '/', 1, type_=String)
+
+        walk = first_path(path.op('~>=~' if prefix else '~>~', is_comparison=True)(prefix)).cte('walk', recursive=True)
+        # The next path not in the subdirectory of the current one. The names of the other subdirectories
+        # sort before its '/' (e.g. 'a-b' before 'a/') or after its '0' (upper bound of 'a/'), so a subdirectory
+        # can be met twice (a, a-b, a/c), never in a loop: every path is greater than the previous one
+        current = subdirectory(walk.c.path_dir)
+        walk = walk.union_all(
+            select(func.coalesce(first_path(path.op('~>~', is_comparison=True)(walk.c.path_dir),
+                                            path.op('~<~', is_comparison=True)(func.concat(prefix, current, '/')))
+                                 .scalar_subquery(),
+                                 first_path(path.op('~>=~', is_comparison=True)(func.concat(prefix, current, '0')))
+                                 .scalar_subquery()))
+            .where(walk.c.path_dir.is_not(None)))
+        name = subdirectory(walk.c.path_dir)
+        stmt = select(name).where(walk.c.path_dir.is_not(None)).distinct().order_by(name)
+        results = await db.execute(statement=stmt)
+        return [f'{path_dir}/{name}' if path_dir else name for name in results.scalars()]
+
+    @staticmethod
+    def _starts_with(column: InstrumentedAttribute, prefix: str) -> ColumnElement[bool]:
+        """Prefix match as a range of the text_pattern_ops operators: unlike LIKE with a bound parameter,
+        it uses the pattern index in a generic plan of a prepared statement too"""
+
+        if ord(prefix[-1]) >= 0xD7FF:
+            return column.startswith(prefix, autoescape=True)
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return and_(column.op('~>=~')(prefix), column.op('~<~')(upper_bound))
+
+    @traced
+    async def save(self, db: AsyncSession, obj_in: FileCreate) -> FileModel:
+        """Create the file or overwrite the existing one at the same path"""
+
+        return await self.upsert(db=db, obj_in=obj_in, **SAVE_UPSERT)
+
+    @traced
+    async def save_multi(self, db: AsyncSession, obj_in_list: list[FileCreate]) -> list[FileModel]:
+        return await self.upsert_multi(db=db, obj_in_list=obj_in_list, **SAVE_UPSERT)
+
 
 class FileService:
     def __init__(self, repo: Type[Repository]):
         self.repo = repo()
 
     async def upload_file_(self, db: AsyncSession, user: UserInDB, file: UploadFile, path_dir: str | None) -> FileModel:
+        return await self.store_file(db, user, file.filename, path_dir, lambda storage, key: storage.stage(file, key))
+
+    @traced
+    async def store_file(self, db: AsyncSession, user: UserInDB, filename: str, path_dir: str | None,
+                         stage: Callable[[StorageBackend, str | None], Awaitable[StagedFile]]) -> FileModel:
+        """Save the content staged by stage(storage, key) as the user's file (key is None for a blob)"""
+
         path_dir = path_dir or ''
-        file_path: AsyncPath = await get_absolute_file_path(user.username, file.filename, path_dir)
-        is_file_path_exists = await file_path.exists()
-        # If the file exists, it will be overwritten
-        await write_file(file, file_path, is_file_path_exists)
+        storage = get_storage()
+        file_key = get_file_key(user.username, filename, path_dir)
+        if app_settings.dedup_storage:
+            return await self._store_blob(db, user, filename, path_dir, stage, file_key)
+        # The upload is staged, so the existing file stays intact until the record is saved
+        staged_file = await stage(storage, file_key)
+        try:
+            file_model_obj = await self._save_file(db, user, path_dir, filename, staged_file)
+            # If the file exists, it will be overwritten
+            await storage.commit(staged_file, file_key)
+        except BaseException:
+            await storage.discard(staged_file)
+            raise
+        return file_model_obj
+
+    @traced
+    async def _store_blob(self, db: AsyncSession, user: UserInDB, filename: str, path_dir: str,
+                          stage: Callable[[StorageBackend, str | None], Awaitable[StagedFile]],
+                          file_key: str) -> FileModel:
+        """Deduplicated storage: the record points to the blob of the content (stored once for all the users)"""
+
+        storage = get_storage()
+        staged_file = await stage(storage, None)
+        try:
+            blob_hash = await blob_service.store(db, staged_file)
+        except BaseException:
+            await storage.discard(staged_file)
+            raise
+        # If the record is not saved, the blob is left unreferenced for the garbage collector
+        file_model_obj = await self._save_file(db, user, path_dir, filename, staged_file, blob_hash)
+        # Uploaded before the deduplication was turned on (no check: the delete costs as much)
+        await storage.delete(file_key)
+        return file_model_obj
+
+    @traced
+    async def upload_files(self, db: AsyncSession, user: UserInDB, files: list[UploadFile],
+                           path_dir: str | None) -> list[FileModel]:
+        uploads = [FileUpload(*get_member_path(file.filename or '', path_dir or ''), file) for file in files]
+        return await self.store_files(db, user, uploads)
+
+    @traced
+    async def upload_tar(self, db: AsyncSession, user: UserInDB, chunks: AsyncIterator[bytes],
+                         path_dir: str | None) -> list[FileModel]:
+        """Store the regular files of the tar archive streamed in chunks, under path_dir by their paths"""
 
-        if is_file_path_exists:
-            db_obj = FileIn(name=file.filename, path_dir=path_dir, user_id=user.id)
-            file_obj = await self.repo.get(db=db, db_obj=db_obj)
-            if file_obj:
-                updated_file_model_obj = await self._update_file(db, file_obj)
-                logging.info(f'"{file.filename}" updated')
-                return updated_file_model_obj
-            logging.warning(f'"{file.filename}" is in storage, but there is no record about it in the database')
+        f = await asyncio.to_thread(tempfile.TemporaryFile, dir=app_settings.storage_path)
+        try:
+            size = 0
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > app_settings.bulk_upload_max_size:
+                    raise UploadTooLargeException(app_settings.bulk_upload_max_size)
+                await asyncio.to_thread(f.write, chunk)
+            await asyncio.to_thread(f.seek, 0)
+            uploads = await asyncio.to_thread(read_tar_members, f, path_dir or '', app_settings.bulk_upload_max_files)
+            return await self.store_files(db, user, uploads)
+        finally:
+            await asyncio.to_thread(f.close)
 
-        new_file_model_obj = await self._create_file(db, user, path_dir, file)
-        logging.info(f'"{file.filename}" created')
+    @traced
+    async def store_files(self, db: AsyncSession, user: UserInDB, uploads: list[FileUpload]) -> list[FileModel]:
+        """Save many files at once: the contents are staged concurrently (bulk_upload_concurrency at a time),
+        the records are saved by one upsert. Of the uploads with the same path the last one is saved"""
 
-        return new_file_model_obj
+        if len(uploads) > app_settings.bulk_upload_max_files:
+            raise ValidationException(f'number of files (max {app_settings.bulk_upload_max_files})')
+        uploads = list({(upload.path_dir, upload.filename): upload for upload in uploads}.values())
+        storage = get_storage()
+        semaphore = asyncio.Semaphore(app_settings.bulk_upload_concurrency)
+        file_keys = [get_file_key(user.username, upload.filename, upload.path_dir) for upload in uploads]
 
+        async def stage(upload: FileUpload, file_key: str) -> StagedFile:
+            async with semaphore:
+                return await storage.stage(upload.file, None if app_settings.dedup_storage else file_key)
+
+        async def apply(method: Callable[..., Awaitable], *args_list: list) -> None:
+            async def call(*args) -> None:
+                async with semaphore:
+                    await method(*args)
+            await asyncio.gather(*(call(*args) for args in zip(*args_list)))
+
+        staged_files = await self._stage_all(storage, [stage(upload, key) for upload, key in zip(uploads, file_keys)])
+        if app_settings.dedup_storage:
+            blob_hashes = await self._store_blobs(db, storage, staged_files)
+            file_objs = await self._save_files(db, user, uploads, staged_files, blob_hashes)
+            # Uploaded before the deduplication was turned on
+            await apply(storage.delete, file_keys)
+            return file_objs
+        try:
+            file_objs = await self._save_files(db, user, uploads, staged_files, [None] * len(uploads))
+            await apply(storage.commit, staged_files, file_keys)
+        except BaseException:
+            await asyncio.gather(*(storage.discard(staged_file) for staged_file in staged_files))
+            raise
+        return file_objs
+
+    @staticmethod
+    @traced
+    async def _stage_all(storage: StorageBackend, stages: list[Awaitable[StagedFile]]) -> list[StagedFile]:
+        """All the uploads staged or none: if one fails, the others are discarded"""
+
+        results = await asyncio.gather(*stages, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await asyncio.gather(*(storage.discard(result) for result in results
+                                   if not isinstance(result, BaseException)))
+            raise errors[0]
+        return results
+
+    @staticmethod
+    @traced
+    async def _store_blobs(db: AsyncSession, storage: StorageBackend, staged_files: list[StagedFile]) -> list[str]:
+        # One session: the blobs are stored one by one
+        blob_hashes = []
+        try:
+            for staged_file in staged_files:
+                blob_hashes.append(await blob_service.store(db, staged_file))
+        except BaseException:
+            await asyncio.gather(*(storage.discard(staged_file) for staged_file in staged_files[len(blob_hashes):]))
+            raise
+        return blob_hashes
+
+    @traced
+    async def _save_files(self, db: AsyncSession, user: UserInDB, uploads: list[FileUpload],
+                          staged_files: list[StagedFile], blob_hashes: list[str | None]) -> list[FileModel]:
+        obj_in_list = [FileCreate(name=upload.filename, path_dir=upload.path_dir, size=staged_file.size,
+                                  user_id=user.id, blob_hash=blob_hash)
+                       for upload, staged_file, blob_hash in zip(uploads, staged_files, blob_hashes)]
+        file_objs = await self.repo.save_multi(db=db, obj_in_list=obj_in_list)
+        logging.info(f'{len(file_objs)} files saved')
+        return file_objs
+
+    @traced
     async def download_file(self, db: AsyncSession,
                             user: UserInDB,
                             filename: str | None,
                             path_dir: str | None,
-                            file_id: str | None
+                            file_id: str | None,
+                            range_header: str | None = None,
+                            if_range: str | None = None
                             ) -> Any:
         if file_id:
             try:
                 db_obj = FileID(id=file_id)
             except Exception as e:
                 raise ValidationException(f'file_id:\n{e}')
-            file_obj = await self.repo.get(db=db, db_obj=db_obj)
-            filename = file_obj.name
-            path_dir = file_obj.path_dir
-
-        file_path = await get_absolute_file_path(user.username, filename, path_dir)
+        else:
+            db_obj = FileIn(name=filename, path_dir=path_dir or '', user_id=user.id)
+        file_obj = await self.repo.get(db=db, db_obj=db_obj)
+        if file_obj is None or file_obj.user_id != user.id:
+            raise FileNotFoundException
+        filename = file_obj.name
 
-        if not await file_path.exists():
+        storage = get_storage()
+        file_key = self._get_storage_key(user, file_obj)
+        file_stat = await storage.stat(file_key)
+        if file_stat is None:
             raise FileNotFoundException
+        file_path = storage.get_local_path(file_key)
+
+        if app_settings.download_mode == 'accel' and file_path:
+            logging.info(f'X-Accel-Redirect for {filename}')
+            return self._get_accel_redirect_response(file_key, filename)
+
+        file_size = file_stat.size
+        headers = {'Accept-Ranges': RANGE_UNIT,
+                   'ETag': get_etag(file_obj),
+                   'Last-Modified': get_last_modified(file_obj)}
 
-        file_stat = await file_path.stat()
-        file_size = file_stat.st_size
+        if range_header and is_range_fresh(if_range, headers['ETag'], headers['Last-Modified']):
+            ranges = parse_range_header(range_header, file_size)
+            if ranges:
+                logging.info(f'Partial StreamingResponse for {filename} (size:{file_size}, ranges:{ranges})')
+                return self._get_partial_response(storage, file_key, filename, file_size, ranges, headers)
 
-        if file_size < app_settings.large_file_size:
+        if file_path and file_size < app_settings.large_file_size:
             logging.info(f'FileResponse for {filename} (size:{file_size})')
-            return FileResponse(file_path, filename=filename)
+            return FileResponse(file_path, filename=filename, headers=headers, stat_result=file_stat.stat_result)
 
         logging.info(f'StreamingResponse for {filename} (size:{file_size})')
-        headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
-        return StreamingResponse(content=file_chunk_generator(file_path),
-                                 media_type="application/octet-stream",
+        headers |= {'Content-Disposition': get_content_disposition(filename), 'Content-Length': str(file_size)}
+        return StreamingResponse(content=storage.read(file_key),
+                                 media_type=OCTET_STREAM,
                                  headers=headers)
 
-    async def get_list_info(self, db: AsyncSession, user_id: UUID, page_params: PaginationParams) -> dict[str, Any]:
+    @traced
+    async def download_archive(self, db: AsyncSession, user: UserInDB, path_dir: str | None,
+                               file_ids: list[UUID] | None, archive_format: str, compression: str
+                               ) -> StreamingResponse:
+        """The files under path_dir (or the ones with file_ids) as one ZIP or TAR archive, generated while
+        it is sent. The names in the archive are relative to path_dir"""
+
+        if file_ids:
+            prefix, filters = '', [self.repo.model.id.in_(file_ids)]
+        else:
+            prefix = (path_dir or '').strip('/')
+            filters = self.repo.get_filters(FileFilterParams(path_dir=prefix))
+        max_files = app_settings.archive_max_files
         file_list = await self.repo.get_multi(db=db,
-                                              obj=dict(user_id=user_id),
-                                              limit=page_params.limit,
-                                              offset=page_params.offset)
-        file_dict = {'user_id': user_id, 'files': [FileInDB.model_validate(file).model_dump() for file in file_list]}
+                                              obj=dict(user_id=user.id),
+                                              limit=max_files + 1,
+                                              offset=0,
+                                              order_by=LIST_ORDERS['path'],
+                                              filters=filters)
+        if not file_list:
+            raise FileNotFoundException
+        if len(file_list) > max_files:
+            raise ValidationException(f'number of files (max {max_files})')
+        entries = [ArchiveEntry(name=posixpath.join(file_obj.path_dir[len(prefix):].lstrip('/'), file_obj.name),
+                                key=self._get_storage_key(user, file_obj),
+                                size=file_obj.size,
+                                modified_at=file_obj.updated_at)
+                   for file_obj in file_list]
+
+        storage = get_storage()
+        if archive_format == 'tar':
+            content = tar_stream_generator(storage, entries)
+        else:
+            content = zip_stream_generator(storage, entries, ZIP_COMPRESSIONS[compression])
+        filename = f'{posixpath.basename(prefix) or "files"}.{archive_format}'
+        logging.info(f'Archive {filename} of {len(entries)} files')
+        return StreamingResponse(content=content,
+                                 media_type=ARCHIVE_MEDIA_TYPES[archive_format],
+                                 headers={'Content-Disposition': get_content_disposition(filename)})
+
+    @traced
+    async def get_list_info(self, db: AsyncSession, user_id: UUID, page_params: PaginationParams,
+                            filter_params: FileFilterParams | None = None) -> dict[str, Any]:
+        filter_params = filter_params or FileFilterParams()
+        order_by = LIST_ORDERS[filter_params.sort]
+        descending = filter_params.order == 'desc'
+        filters = self.repo.get_filters(filter_params)
+        if page_params.cursor:
+            file_list = await self.repo.get_multi_keyset(db=db,
+                                                         obj=dict(user_id=user_id),
+                                                         limit=page_params.limit,
+                                                         order_by=order_by,
+                                                         after=decode_cursor(page_params.cursor, len(order_by)),
+                                                         descending=descending,
+                                                         filters=filters)
+        else:
+            file_list = await self.repo.get_multi(db=db,
+                                                  obj=dict(user_id=user_id),
+                                                  limit=page_params.limit,
+                                                  offset=page_params.offset,
+                                                  order_by=order_by,
+                                                  descending=descending,
+                                                  filters=filters)
+        next_cursor = None
+        if file_list and len(file_list) == page_params.limit:
+            next_cursor = encode_cursor([getattr(file_list[-1], name) for name in order_by])
+        file_dict = {'user_id': user_id,
+                     'files': [FileInDB.model_validate(file).model_dump() for file in file_list],
+                     'next_cursor': next_cursor}
+        # The subdirectories are returned with the first page only
+        if not filter_params.recursive and not page_params.cursor and not page_params.offset:
+            file_dict['common_prefixes'] = await self.repo.get_subdirectories(db=db, user_id=user_id,
+                                                                              path_dir=filter_params.path_dir or '')
         return file_dict
 
-    async def _update_file(self, db: AsyncSession, file_obj: FileModel) -> FileModel:
-        """Change values of the fields (size and updated_at) for overwritten file"""
+    @staticmethod
+    def _get_storage_key(user: UserInDB, file_obj: FileModel) -> str:
+        if file_obj.blob_hash:
+            return get_blob_key(file_obj.blob_hash)
+        return get_file_key(user.username, file_obj.name, file_obj.path_dir)
 
-        obj_in = FileUpdateSize(size=file_obj.size)
-        file_model_obj = await self.repo.update(db=db, db_obj=file_obj, obj_in=obj_in)
+    @staticmethod
+    def _get_accel_redirect_response(file_key: str, filename: str) -> Response:
+        """Empty response: nginx serves the file from its internal location (with sendfile and Range support)"""
 
-        return file_model_obj
+        headers = {'X-Accel-Redirect': app_settings.accel_redirect_location + quote(file_key),
+                   'Content-Disposition': get_content_disposition(filename)}
+        return Response(media_type=OCTET_STREAM, headers=headers)
+
+    @staticmethod
+    def _get_partial_response(storage: StorageBackend, file_key: str, filename: str, file_size: int,
+                              ranges: list[tuple[int, int]], headers: dict[str, str]) -> StreamingResponse:
+        """206 response: a single range as is, several ranges as multipart/byteranges"""
+
+        headers['Content-Disposition'] = get_content_disposition(filename)
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            headers |= {'Content-Range': get_content_range(first, last, file_size),
+                        'Content-Length': str(last - first + 1)}
+            content = storage.read(file_key, offset=first, length=last - first + 1)
+            media_type = OCTET_STREAM
+        else:
+            boundary = uuid4().hex
+            headers['Content-Length'] = str(get_multipart_length(ranges, file_size, boundary, OCTET_STREAM))
+            content = multipart_byteranges_generator(storage, file_key, ranges, file_size, boundary, OCTET_STREAM)
+            media_type = f'multipart/byteranges; boundary={boundary}'
+        return StreamingResponse(content=content,
+                                 status_code=status.HTTP_206_PARTIAL_CONTENT,
+                                 media_type=media_type,
+                                 headers=headers)
+
+    @traced
+    async def export_files(self, db: AsyncSession, user_id: UUID, filter_params: FileFilterParams,
+                           export_format: str) -> StreamingResponse:
+        """The whole (filtered) catalogue of the user as NDJSON or CSV, streamed from a server-side cursor"""
+
+        keep_session_open(db)
+        batches = self.repo.stream_multi(db=db,
+                                         obj=dict(user_id=user_id),
+                                         columns=EXPORT_COLUMNS,
+                                         batch_size=app_settings.export_batch_size,
+                                         order_by=LIST_ORDERS['path'],
+                                         filters=self.repo.get_filters(filter_params))
+        if export_format == 'csv':
+            content, media_type = csv_batch_generator(batches, EXPORT_COLUMNS), 'text/csv; charset=utf-8'
+        else:
+            content, media_type = ndjson_batch_generator(batches), 'application/x-ndjson'
+        headers = {'Content-Disposition': get_content_disposition(f'files.{export_format}')}
+        return StreamingResponse(content=content, media_type=media_type, headers=headers)
+
+    @traced
+    async def _save_file(self, db: AsyncSession, user: UserInDB, path_dir: str, filename: str,
+                         staged_file: StagedFile, blob_hash: str | None = None) -> FileModel:
+        """Create the record or overwrite the one at the path in one round-trip (single upsert)"""
 
-    async def _create_file(self, db: AsyncSession, user: UserInDB, path_dir: str, file: UploadFile) -> FileModel:
-        file_obj = FileCreate(name=file.filename, path_dir=path_dir, size=file.size, user_id=user.id)
-        file_model_obj = await self.repo.create(db=db, obj_in=file_obj)
+        obj_in = FileCreate(name=filename, path_dir=path_dir, size=staged_file.size, user_id=user.id,
+                            blob_hash=blob_hash)
+        file_model_obj = await self.repo.save(db=db, obj_in=obj_in)
+        logging.info(f'"{filename}" saved (sha256:{staged_file.checksum})')
         return file_model_obj
 
 
@@ -1,10 +1,29 @@
-from typing import Type
+import asyncio
+import io
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Type
 
+from fastapi import UploadFile
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.pool import QueuePool
 
+from src.core.config import app_settings
+from src.db.db import MeteredQueuePool, engine
 from src.services.base_service import SQLAlchemyRepository, Repository
+from src.services.cache import TTLCache, caches
+from src.services.storage import get_storage
 from src.services.utils import form_message, execution_time
 
+SUCCESS = 'success'
+DEGRADED = 'degraded'
+ERROR = 'error'
+# Worst first
+STATUSES = [ERROR, DEGRADED, SUCCESS]
+HEALTH_DIR = '.health'
+PROBE_CONTENT = b'health probe'
+
 
 class HealthRepository(SQLAlchemyRepository):
     model = None
@@ -13,13 +32,105 @@ class HealthRepository(SQLAlchemyRepository):
 class HealthService:
     def __init__(self, repo: Type[Repository]):
         self.repo = repo()
+        self.cache: TTLCache[str, dict[str, Any]] = TTLCache('health', 1, app_settings.health_cache_ttl)
+        # The requests coming while the probes run wait for their result
+        self._lock = asyncio.Lock()
 
     async def get_ping(self, db: AsyncSession) -> dict[str, str]:
         service = 'db'
+        health = await self.get_health(db=db)
+        db_check = health['checks'][service]
+        if db_check['status'] == SUCCESS:
+            return form_message(service=service, status=SUCCESS, info=db_check['info'])
+        return form_message(service=service, status=ERROR, info='Database is currently unavailable')
+
+    async def get_health(self, db: AsyncSession) -> dict[str, Any]:
+        """Status of the dependencies: database, storage, connection pool.
+        The probes run concurrently, the result is cached for health_cache_ttl seconds"""
+
+        health = self.cache.get('health')
+        if health is not None:
+            return health
+        async with self._lock:
+            health = self.cache.get('health')
+            if health is None:
+                health = await self._check_all(db)
+                self.cache.set('health', health)
+        return health
+
+    async def get_cache_stats(self) -> dict[str, dict[str, int]]:
+        return {name: cache.stats() for name, cache in caches.items()}
+
+    async def get_pool_stats(self) -> dict[str, Any]:
+        return engine.pool.stats()
+
+    async def _check_all(self, db: AsyncSession) -> dict[str, Any]:
+        probes = {'db': lambda: self._check_db(db),
+                  'storage': self._check_storage,
+                  'pool': lambda: self._check_pool(db)}
+        results = await asyncio.gather(*(self._run_probe(name, probe) for name, probe in probes.items()))
+        checks = dict(zip(probes, results))
+        status = min((check['status'] for check in checks.values()), key=STATUSES.index)
+        return dict(status=status, checks=checks)
+
+    @staticmethod
+    async def _run_probe(name: str, probe: Callable[[], Awaitable[dict[str, Any]]]) -> dict[str, Any]:
+        try:
+            return await asyncio.wait_for(probe(), app_settings.health_probe_timeout)
+        except asyncio.TimeoutError:
+            info = f'No answer in {app_settings.health_probe_timeout} s'
+        except Exception as e:
+            info = f'{type(e).__name__}: {e}'
+        logging.error(f'Health check of {name} failed: {info}')
+        return form_message(status=ERROR, info=info)
+
+    async def _check_db(self, db: AsyncSession) -> dict[str, Any]:
         result, execution_time = await self._get_status_db(db=db)
         if result:
-            return form_message(service=service, status='success', info=f'{execution_time:.4f} s')
-        return form_message(service=service, status='error', info='Database is currently unavailable')
+            return form_message(status=SUCCESS, info=f'{execution_time:.4f} s')
+        return form_message(status=ERROR, info='Database is currently unavailable')
+
+    @staticmethod
+    async def _check_storage() -> dict[str, Any]:
+        """Write, read back and delete a small object, report the free space"""
+
+        storage = get_storage()
+        key = f'{HEALTH_DIR}/{os.getpid()}'
+        start = time.perf_counter()
+        staged_file = await storage.stage(UploadFile(io.BytesIO(PROBE_CONTENT)), key)
+        await storage.commit(staged_file, key)
+        write_time = time.perf_counter() - start
+        start = time.perf_counter()
+        content = b''.join([chunk async for chunk in storage.read(key)])
+        read_time = time.perf_counter() - start
+        await storage.delete(key)
+        if content != PROBE_CONTENT:
+            return form_message(status=ERROR, info='The probe object is read back changed')
+
+        free_space = await storage.get_free_space()
+        status = SUCCESS
+        if free_space is not None and free_space < app_settings.health_min_free_space:
+            status = DEGRADED
+        return form_message(status=status, info=f'write {write_time:.4f} s, read {read_time:.4f} s') | dict(
+            free_space=free_space)
+
+    @staticmethod
+    async def _check_pool(db: AsyncSession) -> dict[str, Any]:
+        """Connections of the pool checked out by the requests of this worker process"""
+
+        pool = db.bind.pool
+        if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+            return form_message(status=SUCCESS, info=f'{type(pool).__name__}, not limited')
+        capacity = pool.size() + pool._max_overflow
+        checked_out = pool.checkedout()
+        saturation = checked_out / capacity
+        status = DEGRADED if saturation > app_settings.health_pool_saturation else SUCCESS
+        if isinstance(pool, MeteredQueuePool):
+            stats = pool.stats()
+        else:
+            stats = dict(size=pool.size(), checked_out=checked_out, overflow=pool.overflow())
+        return form_message(status=status, info=f'{checked_out} of {capacity} connections in use') | stats | dict(
+            saturation=round(saturation, 3))
 
     @execution_time
     async def _get_status_db(self, db: AsyncSession) -> bool:
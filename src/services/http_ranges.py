@@ -0,0 +1,127 @@
+from email.utils import format_datetime, parsedate_to_datetime
+
+from src.exceptions import RangeNotSatisfiableException
+from src.models.file_model import File as FileModel
+from src.services.storage import StorageBackend
+from src.services.utils import as_utc
+
+RANGE_UNIT = 'bytes'
+# More ranges than this in one request are ignored and the whole file is sent
+MAX_RANGES = 50
+
+
+def get_etag(file_obj: FileModel) -> str:
+    """Strong validator of the stored file: changes on every overwrite"""
+
+    updated_at = int(as_utc(file_obj.updated_at).timestamp() * 1_000_000)
+    return f'"{file_obj.id.hex}-{updated_at:x}-{file_obj.size:x}"'
+
+
+def get_last_modified(file_obj: FileModel) -> str:
+    return format_datetime(as_utc(file_obj.updated_at).replace(microsecond=0), usegmt=True)
+
+
+def is_range_fresh(if_range: str | None, etag: str, last_modified: str) -> bool:
+    """If-Range: the Range header is honored only if the client's copy is still the current one"""
+
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', 'W/')):
+        # Weak validators never match
+        return if_range == etag
+    try:
+        return parsedate_to_datetime(if_range) == parsedate_to_datetime(last_modified)
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_range_header(range_header: str, file_size: int) -> list[tuple[int, int]] | None:
+    """Return the list of (first, last) byte positions, both inclusive, sorted, the overlapping and adjacent
+    ranges merged (RFC 7233, 6.1). None means the header has to be ignored (a different unit, invalid syntax,
+    too many ranges, ranges longer than the file together)"""
+
+    unit, _, range_set = range_header.partition('=')
+    if unit.strip().lower() != RANGE_UNIT or not range_set.strip():
+        return None
+    range_specs = range_set.split(',')
+    if len(range_specs) > MAX_RANGES:
+        return None
+
+    try:
+        ranges = [byte_range for range_spec in range_specs
+                  if (byte_range := _parse_range_spec(range_spec, file_size)) is not None]
+    except ValueError:
+        return None
+
+    if not ranges:
+        raise RangeNotSatisfiableException(file_size)
+    if sum(last - first + 1 for first, last in ranges) > file_size:
+        return None
+    return _merge_ranges(ranges)
+
+
+def _parse_range_spec(range_spec: str, file_size: int) -> tuple[int, int] | None:
+    """(first, last) of 'first-last', 'first-' or '-suffix', None if it is not satisfiable.
+    ValueError if the syntax is invalid"""
+
+    first, sep, last = (part.strip() for part in range_spec.partition('-'))
+    if not sep or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        raise ValueError(range_spec)
+    if not first:
+        # Suffix range: the last N bytes
+        suffix_length = int(last)
+        if suffix_length and file_size:
+            return max(file_size - suffix_length, 0), file_size - 1
+        return None
+    first = int(first)
+    last = int(last) if last else file_size - 1
+    if last < first:
+        raise ValueError(range_spec)
+    if first < file_size:
+        return first, min(last, file_size - 1)
+    return None
+
+
+def _merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def get_content_range(first: int, last: int, file_size: int) -> str:
+    return f'{RANGE_UNIT} {first}-{last}/{file_size}'
+
+
+def _get_part_headers(first: int, last: int, file_size: int, boundary: str, media_type: str) -> bytes:
+    return (f'--{boundary}\r\n'
+            f'Content-Type: {media_type}\r\n'
+            f'Content-Range: {get_content_range(first, last, file_size)}\r\n\r\n').encode()
+
+
+def _get_closing_boundary(boundary: str) -> bytes:
+    return f'--{boundary}--\r\n'.encode()
+
+
+def get_multipart_length(ranges: list[tuple[int, int]], file_size: int, boundary: str, media_type: str) -> int:
+    length = len(_get_closing_boundary(boundary))
+    for first, last in ranges:
+        # Part headers, part body and the CRLF after it
+        length += len(_get_part_headers(first, last, file_size, boundary, media_type)) + last - first + 1 + 2
+    return length
+
+
+async def multipart_byteranges_generator(storage: StorageBackend, key: str, ranges: list[tuple[int, int]],
+                                         file_size: int, boundary: str, media_type: str):
+    """Body of a multipart/byteranges response: reads only the requested bytes of the file"""
+
+    for first, last in ranges:
+        yield _get_part_headers(first, last, file_size, boundary, media_type)
+        async for chunk in storage.read(key, offset=first, length=last - first + 1):
+            yield chunk
+        yield b'\r\n'
+    yield _get_closing_boundary(boundary)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import NamedTuple
+
+from src.core.config import app_settings
+from src.services.metrics import EVENT_LOOP_BLOCKS, EVENT_LOOP_LAG
+
+
+class LoopBlock(NamedTuple):
+    # Seconds the loop was blocked when it was caught (at least)
+    duration: float
+    task: str
+    stack: str
+
+
+class LoopBlockedError(RuntimeError):
+    pass
+
+
+class LoopMonitor:
+    """Event-loop watchdog. A task sleeping interval seconds measures how late the loop wakes it up
+    (event_loop_lag_seconds). A thread watches the task: when it is late by threshold seconds, the loop is held
+    by a blocking call, whose stack (of the loop thread) is logged. In strict mode the blocks are also kept:
+    check() raises if there are any"""
+
+    def __init__(self, interval: float | None = None, threshold: float | None = None, strict: bool = False):
+        self.interval = interval or app_settings.loop_monitor_interval
+        self.threshold = threshold or app_settings.loop_monitor_threshold
+        self.strict = strict
+        self.blocks: list[LoopBlock] = []
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        # When the heartbeat is due (time.monotonic()), None while the loop is stopped
+        self._due: float | None = None
+        self._beats = 0
+
+    def start(self) -> None:
+        """Called in the loop to watch"""
+
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._due = time.monotonic() + self.interval
+        self._task = self._loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='loop-monitor', daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.to_thread(self._thread.join)
+
+    def check(self) -> None:
+        """Strict mode: raise if the loop was blocked since the last check"""
+
+        if self.blocks:
+            blocks, self.blocks = self.blocks, []
+            raise LoopBlockedError('\n'.join(f'Event loop blocked for more than {block.duration * 1000:.0f} ms '
+                                             f'by {block.task}:\n{block.stack}' for block in blocks))
+
+    async def _heartbeat(self) -> None:
+        while True:
+            start = time.perf_counter()
+            self._due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._beats += 1
+            EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - self.interval))
+
+    def _watch(self) -> None:
+        reported_beat = -1
+        while not self._stop.wait(min(self.interval, self.threshold) / 4):
+            if not self._loop.is_running():
+                # Stopped between two runs (run_until_complete): nothing holds it
+                self._due = None
+                continue
+            now = time.monotonic()
+            if self._due is None:
+                self._due = now
+                continue
+            late = now - self._due
+            # A block is reported once, when it gets longer than the threshold
+            if late >= self.threshold and reported_beat != self._beats:
+                reported_beat = self._beats
+                self._report(late)
+
+    def _report(self, duration: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+        task = asyncio.current_task(self._loop)
+        block = LoopBlock(duration=duration, task=repr(task) if task is not None else 'a callback', stack=stack)
+        EVENT_LOOP_BLOCKS.inc()
+        logging.warning(f'Event loop blocked for more than {duration * 1000:.0f} ms by {block.task}:\n{stack}')
+        if self.strict:
+            self.blocks.append(block)
@@ -0,0 +1,111 @@
+import os
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Under gunicorn every worker writes its metrics to the files of this directory (prometheus_client
+# multiprocess mode, see src/core/gunicorn_conf.py), /metrics of any worker sums them up
+MULTIPROCESS_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+UNMATCHED_ROUTE = '<unmatched>'
+DB_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE'}
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Time to the end of the response',
+                             ['method', 'route', 'status'])
+REQUESTS_IN_PROGRESS = Gauge('http_requests_in_progress', 'Requests being served', ['method'],
+                             multiprocess_mode='livesum')
+REQUEST_BYTES = Counter('http_request_bytes', 'Bytes of the request bodies (uploaded)', ['route'])
+RESPONSE_BYTES = Counter('http_response_bytes', 'Bytes of the response bodies (downloaded)', ['route'])
+DB_QUERY_DURATION = Histogram('db_query_duration_seconds', 'Statements executed by the database', ['operation'],
+                              buckets=FAST_BUCKETS)
+PASSWORD_HASH_DURATION = Histogram('password_hash_duration_seconds', 'bcrypt in the thread pool', ['operation'])
+FILE_IO_DURATION = Histogram('file_io_duration_seconds', 'Time a file upload or download spent in file I/O',
+                             ['operation'], buckets=FAST_BUCKETS)
+EVENT_LOOP_LAG = Histogram('event_loop_lag_seconds', 'How late the event loop runs a timer', buckets=FAST_BUCKETS)
+EVENT_LOOP_BLOCKS = Counter('event_loop_blocks', 'Blocking calls holding the event loop longer than the threshold')
+
+
+class MetricsMiddleware:
+    """Latency by route (the path template) and status, requests in progress, body bytes.
+    Pure ASGI: the streamed bodies are counted as they pass, nothing is buffered"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        method = scope['method']
+        status_code = 500
+        received = 0
+        sent = 0
+
+        async def receive_counted() -> Message:
+            nonlocal received
+            message = await receive()
+            received += len(message.get('body', b''))
+            return message
+
+        async def send_counted(message: Message) -> None:
+            nonlocal status_code, sent
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            else:
+                sent += len(message.get('body', b''))
+            await send(message)
+
+        in_progress = REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            in_progress.dec()
+            # Set by the router for the matched route
+            route = scope.get('route')
+            route_path = route.path if route is not None else UNMATCHED_ROUTE
+            REQUEST_DURATION.labels(method, route_path, status_code).observe(time.perf_counter() - start)
+            if received:
+                REQUEST_BYTES.labels(route_path).inc(received)
+            if sent:
+                RESPONSE_BYTES.labels(route_path).inc(sent)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    context.metrics_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    # The operations counted apart are all 6 letters long
+    operation = statement[:6].upper()
+    if operation not in DB_OPERATIONS:
+        operation = 'OTHER'
+    DB_QUERY_DURATION.labels(operation).observe(time.perf_counter() - context.metrics_start_time)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Count and time the statements of the engine"""
+
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def generate_metrics() -> bytes:
+    """Text exposition of the metrics of all the worker processes (blocking: reads their files)"""
+
+    if os.environ.get(MULTIPROCESS_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def mark_process_dead(pid: int) -> None:
+    if os.environ.get(MULTIPROCESS_DIR_ENV):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,377 @@
+import asyncio
+import hashlib
+import hmac
+import math
+import os
+import shutil
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, NamedTuple
+from urllib.parse import quote
+from uuid import uuid4
+from xml.etree import ElementTree
+
+import httpx
+from aiopath import AsyncPath
+from fastapi import UploadFile
+
+from src.core.config import app_settings
+from src.exceptions import StorageUnavailableException
+from src.services.utils import (write_temp_file, replace_file, remove_file, create_dir_if_not_exists,
+                                file_chunk_generator, get_temp_path, link_file)
+
+# Uploads whose key is not known in advance (the blobs) are staged under this prefix
+STAGING_DIR = '.staging'
+
+
+class StagedFile(NamedTuple):
+    """Upload written to the storage, but not visible by its key until StorageBackend.commit"""
+    size: int
+    checksum: str
+    # Backend-specific state of the upload
+    handle: Any
+
+
+class FileStat(NamedTuple):
+    size: int
+    # Local files only: lets FileResponse skip its own stat
+    stat_result: os.stat_result | None = None
+
+
+class StorageBackend(ABC):
+    """Where the content of the files is kept. Keys are relative posix paths ('username/dir/name')"""
+
+    @abstractmethod
+    async def stage(self, file: UploadFile, key: str | None = None) -> StagedFile:
+        """Stream the upload to the storage counting its size and sha256.
+        key is the final key if it is known in advance (the backend may write there without a copy)"""
+        raise NotImplementedError
+
+    async def stage_file(self, file_path: AsyncPath, key: str | None = None) -> StagedFile:
+        """Stage a complete local file (a finished resumable upload), the file itself is kept"""
+
+        f = await asyncio.to_thread(open, file_path, 'rb')
+        try:
+            return await self.stage(UploadFile(f), key)
+        finally:
+            await asyncio.to_thread(f.close)
+
+    @abstractmethod
+    async def commit(self, staged: StagedFile, key: str) -> None:
+        """Atomically put the staged upload in place of the object with the key"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def discard(self, staged: StagedFile) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def stat(self, key: str) -> FileStat | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def read(self, key: str, offset: int = 0, length: int | None = None) -> AsyncIterator[bytes]:
+        """Stream the bytes [offset, offset + length) of the object (to the end if length is None)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def exists(self, key: str) -> bool:
+        return await self.stat(key) is not None
+
+    def get_local_path(self, key: str) -> AsyncPath | None:
+        """Path of the object on the local disk, None if the backend is remote"""
+        return None
+
+    async def get_free_space(self) -> int | None:
+        """Bytes left for the files, None if the backend doesn't tell"""
+        return None
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalStorage(StorageBackend):
+    """Files in app_settings.storage_path"""
+
+    def get_local_path(self, key: str) -> AsyncPath:
+        return AsyncPath(app_settings.storage_path, key)
+
+    async def get_free_space(self) -> int:
+        usage = await asyncio.to_thread(shutil.disk_usage, app_settings.storage_path)
+        return usage.free
+
+    async def stage(self, file: UploadFile, key: str | None = None) -> StagedFile:
+        # The temp file is renamed into place, so it is written in the same file system
+        written_file = await write_temp_file(file, self.get_local_path(key or f'{STAGING_DIR}/upload'))
+        return StagedFile(size=written_file.size, checksum=written_file.checksum, handle=written_file.temp_path)
+
+    async def stage_file(self, file_path: AsyncPath, key: str | None = None) -> StagedFile:
+        # Linked, not copied: the file is in the same file system
+        temp_path = get_temp_path(self.get_local_path(key or f'{STAGING_DIR}/upload'))
+        await create_dir_if_not_exists(temp_path)
+        try:
+            size, checksum = await asyncio.to_thread(link_file, str(file_path), str(temp_path))
+        except BaseException:
+            await remove_file(temp_path)
+            raise
+        return StagedFile(size=size, checksum=checksum, handle=temp_path)
+
+    async def commit(self, staged: StagedFile, key: str) -> None:
+        file_path = self.get_local_path(key)
+        await create_dir_if_not_exists(file_path)
+        await replace_file(staged.handle, file_path)
+
+    async def discard(self, staged: StagedFile) -> None:
+        await remove_file(staged.handle)
+
+    async def stat(self, key: str) -> FileStat | None:
+        try:
+            stat_result = await self.get_local_path(key).stat()
+        except FileNotFoundError:
+            return None
+        return FileStat(size=stat_result.st_size, stat_result=stat_result)
+
+    def read(self, key: str, offset: int = 0, length: int | None = None) -> AsyncIterator[bytes]:
+        return file_chunk_generator(self.get_local_path(key), offset=offset, length=length)
+
+    async def delete(self, key: str) -> None:
+        await remove_file(self.get_local_path(key))
+
+
+def sign_request(method: str, url: httpx.URL, headers: dict[str, str], payload_hash: str,
+                 access_key: str, secret_key: str, region: str, now: datetime | None = None) -> dict[str, str]:
+    """AWS Signature Version 4 (the S3 flavour: the path is encoded once). Returns the headers to send"""
+
+    amz_date = (now or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+    scope = f'{amz_date[:8]}/{region}/s3/aws4_request'
+    headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+    headers |= {'host': url.netloc.decode(), 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash}
+    signed_headers = ';'.join(sorted(headers))
+    canonical_request = '\n'.join([method,
+                                   url.raw_path.decode().partition('?')[0],
+                                   url.query.decode(),
+                                   ''.join(f'{name}:{headers[name]}\n' for name in sorted(headers)),
+                                   signed_headers,
+                                   payload_hash])
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                hashlib.sha256(canonical_request.encode()).hexdigest()])
+    signing_key = f'AWS4{secret_key}'.encode()
+    for part in scope.split('/'):
+        signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers['authorization'] = (f'AWS4-HMAC-SHA256 Credential={access_key}/{scope}, '
+                                f'SignedHeaders={signed_headers}, Signature={signature}')
+    return headers
+
+
+def _quote(value: str, safe: str = '') -> str:
+    return quote(value, safe='-_.~' + safe)
+
+
+@dataclass
+class _MultipartUpload:
+    key: str
+    upload_id: str
+    # Written to a staging key, has to be copied on the commit
+    is_staging: bool
+    etags: dict[int, str] = field(default_factory=dict)
+
+
+class S3Storage(StorageBackend):
+    """Objects in a bucket of an S3-compatible storage (AWS S3, MinIO, Ceph...), path-style addressing.
+    Uploads larger than a part go as multipart uploads, the reads are ranged GETs"""
+
+    # Limits of S3
+    MAX_COPY_SIZE = 5 * 1024 ** 3
+    MAX_PARTS = 10_000
+
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        self._transport = transport
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on the first request: the connection pool belongs to the running event loop
+        if self._client is None:
+            limits = httpx.Limits(max_connections=app_settings.s3_max_connections,
+                                  max_keepalive_connections=app_settings.s3_max_connections)
+            self._client = httpx.AsyncClient(transport=self._transport, limits=limits,
+                                             timeout=app_settings.s3_timeout)
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _get_object_path(self, key: str) -> str:
+        return f'/{app_settings.s3_bucket}/{_quote(app_settings.s3_prefix + key, safe="/")}'
+
+    async def _send(self, method: str, key: str, params: dict[str, str] | None = None,
+                    headers: dict[str, str] | None = None, content: bytes = b'',
+                    stream: bool = False, expected: tuple[int, ...] = ()) -> httpx.Response:
+        query = '&'.join(f'{_quote(name)}={_quote(value)}' for name, value in sorted((params or {}).items()))
+        url = httpx.URL(app_settings.s3_endpoint_url.rstrip('/') + self._get_object_path(key)
+                        + (f'?{query}' if query else ''))
+        headers = sign_request(method, url, headers or {}, hashlib.sha256(content).hexdigest(),
+                               app_settings.s3_access_key, app_settings.s3_secret_key, app_settings.s3_region)
+        request = self.client.build_request(method, url, headers=headers, content=content)
+        try:
+            response = await self.client.send(request, stream=stream)
+        except httpx.HTTPError as e:
+            raise StorageUnavailableException(f'{method} {key}: {e!r}')
+        if response.is_success or response.status_code in expected:
+            return response
+        body = await response.aread()
+        await response.aclose()
+        raise StorageUnavailableException(f'{method} {key}: {response.status_code} {body[:200]!r}')
+
+    @staticmethod
+    def _find(response: httpx.Response, tag: str) -> str | None:
+        # S3 XML responses have a namespace
+        for element in ElementTree.fromstring(response.content).iter():
+            if element.tag.rpartition('}')[2] == tag:
+                return element.text
+        return None
+
+    async def stage(self, file: UploadFile, key: str | None = None) -> StagedFile:
+        part_size = app_settings.s3_part_size
+        checksum = hashlib.sha256()
+        size = 0
+        buffer = bytearray()
+        upload: _MultipartUpload | None = None
+        parts_in_flight: set[asyncio.Task] = set()
+        try:
+            while chunk := await file.read(app_settings.upload_chunk_size):
+                checksum.update(chunk)
+                size += len(chunk)
+                buffer += chunk
+                while len(buffer) >= part_size:
+                    upload = upload or await self._create_multipart_upload(key)
+                    await self._upload_part_in_background(upload, bytes(buffer[:part_size]), parts_in_flight)
+                    del buffer[:part_size]
+            if upload is None:
+                # Fits in a single request: kept in memory until the commit
+                return StagedFile(size=size, checksum=checksum.hexdigest(), handle=bytes(buffer))
+            if buffer:
+                await self._upload_part_in_background(upload, bytes(buffer), parts_in_flight)
+            await asyncio.gather(*parts_in_flight)
+        except BaseException:
+            for task in parts_in_flight:
+                task.cancel()
+            await asyncio.gather(*parts_in_flight, return_exceptions=True)
+            if upload is not None:
+                await self._abort_multipart_upload(upload)
+            raise
+        return StagedFile(size=size, checksum=checksum.hexdigest(), handle=upload)
+
+    async def commit(self, staged: StagedFile, key: str) -> None:
+        if isinstance(staged.handle, bytes):
+            await self._send('PUT', key, content=staged.handle)
+            return
+        upload: _MultipartUpload = staged.handle
+        await self._complete_multipart_upload(upload)
+        if upload.is_staging:
+            await self._copy(upload.key, key, staged.size)
+            await self.delete(upload.key)
+
+    async def discard(self, staged: StagedFile) -> None:
+        if isinstance(staged.handle, _MultipartUpload):
+            await self._abort_multipart_upload(staged.handle)
+            if staged.handle.is_staging:
+                # The upload may be completed already (the copy failed)
+                await self.delete(staged.handle.key)
+
+    async def stat(self, key: str) -> FileStat | None:
+        response = await self._send('HEAD', key, expected=(404,))
+        if response.status_code == 404:
+            return None
+        return FileStat(size=int(response.headers['content-length']))
+
+    async def read(self, key: str, offset: int = 0, length: int | None = None) -> AsyncIterator[bytes]:
+        headers = {}
+        if offset or length is not None:
+            last = '' if length is None else offset + length - 1
+            headers['range'] = f'bytes={offset}-{last}'
+        response = await self._send('GET', key, headers=headers, stream=True)
+        try:
+            async for chunk in response.aiter_bytes(app_settings.download_chunk_size):
+                yield chunk
+        finally:
+            await response.aclose()
+
+    async def delete(self, key: str) -> None:
+        await self._send('DELETE', key, expected=(404,))
+
+    async def _create_multipart_upload(self, key: str | None) -> _MultipartUpload:
+        upload_key = key or f'{STAGING_DIR}/{uuid4().hex}'
+        response = await self._send('POST', upload_key, params={'uploads': ''})
+        return _MultipartUpload(key=upload_key, upload_id=self._find(response, 'UploadId'), is_staging=key is None)
+
+    async def _upload_part_in_background(self, upload: _MultipartUpload, part: bytes,
+                                         parts_in_flight: set[asyncio.Task]) -> None:
+        """Start the part upload once there are less than s3_upload_concurrency parts in flight"""
+
+        if len(parts_in_flight) >= app_settings.s3_upload_concurrency:
+            done, _ = await asyncio.wait(parts_in_flight, return_when=asyncio.FIRST_COMPLETED)
+            parts_in_flight -= done
+            for task in done:
+                task.result()
+        part_number = len(upload.etags) + 1
+        # The number is taken now, the ETag is set when the part is uploaded
+        upload.etags[part_number] = ''
+        parts_in_flight.add(asyncio.create_task(self._upload_part(upload, part_number, part)))
+
+    async def _upload_part(self, upload: _MultipartUpload, part_number: int, part: bytes) -> None:
+        response = await self._send('PUT', upload.key, content=part,
+                                    params={'partNumber': str(part_number), 'uploadId': upload.upload_id})
+        upload.etags[part_number] = response.headers['etag']
+
+    async def _complete_multipart_upload(self, upload: _MultipartUpload) -> None:
+        parts = ''.join(f'<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>'
+                        for number, etag in sorted(upload.etags.items()))
+        content = f'<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>'.encode()
+        response = await self._send('POST', upload.key, params={'uploadId': upload.upload_id}, content=content)
+        # The error may come with 200 OK
+        if self._find(response, 'Code') is not None:
+            raise StorageUnavailableException(f'POST {upload.key}: {response.content[:200]!r}')
+
+    async def _abort_multipart_upload(self, upload: _MultipartUpload) -> None:
+        await self._send('DELETE', upload.key, params={'uploadId': upload.upload_id}, expected=(404,))
+
+    async def _copy(self, source_key: str, key: str, size: int) -> None:
+        copy_source = {'x-amz-copy-source': self._get_object_path(source_key)}
+        if size <= self.MAX_COPY_SIZE:
+            response = await self._send('PUT', key, headers=copy_source)
+            if self._find(response, 'Code') is not None:
+                raise StorageUnavailableException(f'PUT {key}: {response.content[:200]!r}')
+            return
+        # Larger objects are copied part by part
+        upload = await self._create_multipart_upload(key)
+        part_size = max(app_settings.s3_part_size, math.ceil(size / self.MAX_PARTS))
+        try:
+            for part_number, first in enumerate(range(0, size, part_size), start=1):
+                last = min(first + part_size, size) - 1
+                response = await self._send('PUT', key,
+                                            params={'partNumber': str(part_number), 'uploadId': upload.upload_id},
+                                            headers=copy_source | {'x-amz-copy-source-range': f'bytes={first}-{last}'})
+                upload.etags[part_number] = self._find(response, 'ETag')
+            await self._complete_multipart_upload(upload)
+        except BaseException:
+            await self._abort_multipart_upload(upload)
+            raise
+
+
+# Backends by the name in app_settings.storage_backend
+storage_backends: dict[str, StorageBackend] = {
+    'local': LocalStorage(),
+    's3': S3Storage(),
+}
+
+
+def get_storage() -> StorageBackend:
+    return storage_backends[app_settings.storage_backend]
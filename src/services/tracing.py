@@ -0,0 +1,263 @@
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from typing import Any, Awaitable, Callable, NamedTuple, TypeVar
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.core.config import app_settings
+
+T = TypeVar('T')
+
+PROFILERS = ('none', 'cprofile', 'pyinstrument')
+# The control file is looked at no more often
+CONTROL_CHECK_INTERVAL = 1
+# Spans listed in the report of a request (all of them are in the totals)
+MAX_SPANS = 1000
+PROFILE_LINES = 60
+
+
+class SpanRecord(NamedTuple):
+    name: str
+    depth: int
+    start: float
+    duration: float
+
+
+class Trace:
+    """Spans of a request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: list[SpanRecord] = []
+        self.dropped = 0
+        # name: [calls, time]
+        self.totals: dict[str, list] = {}
+
+    def add(self, name: str, depth: int, start: float, duration: float) -> None:
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append(SpanRecord(name, depth, start, duration))
+        else:
+            self.dropped += 1
+        total = self.totals.setdefault(name, [0, 0.0])
+        total[0] += 1
+        total[1] += duration
+
+    def format(self, title: str) -> str:
+        lines = [title, '    start ms  duration ms']
+        for record in sorted(self.spans, key=lambda record: record.start):
+            lines.append(f'{(record.start - self.start) * 1000:>12.2f} {record.duration * 1000:>12.2f}  '
+                         f'{"  " * record.depth}{record.name}')
+        if self.dropped:
+            lines.append(f'... {self.dropped} spans more')
+        lines.append('       calls      time ms  (by name)')
+        for name, (calls, total) in sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True):
+            lines.append(f'{calls:>12} {total * 1000:>12.2f}  {name}')
+        return '\n'.join(lines)
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar('current_trace', default=None)
+_span_depth: ContextVar[int] = ContextVar('span_depth', default=0)
+
+
+class Span:
+    """Times the block: `with Span('name') as span: ...`, then span.duration.
+    Within a traced request the block is also recorded as a span of the request (nested in the enclosing one)"""
+
+    __slots__ = ('name', 'duration', '_trace', '_start', '_token')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.duration = 0.0
+
+    def __enter__(self) -> 'Span':
+        self._trace = _current_trace.get()
+        if self._trace is not None:
+            self._token = _span_depth.set(_span_depth.get() + 1)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.duration = time.perf_counter() - self._start
+        if self._trace is not None:
+            _span_depth.reset(self._token)
+            self._trace.add(self.name, _span_depth.get(), self._start, self.duration)
+
+
+def traced(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """Span of the coroutine function named by its qualified name. Nothing is timed out of a traced request"""
+
+    name = func.__qualname__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs) -> T:
+        if _current_trace.get() is None:
+            return await func(*args, **kwargs)
+        with Span(name):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+class TracingControl:
+    """The tracing settings of app_settings (trace_*), overridden by the keys of the control file
+    (JSON: enabled, slow_request, profiler, profile_sample_rate). The file is checked at most once a second,
+    so it turns the tracing of every worker process on and off without a restart"""
+
+    def __init__(self):
+        self.enabled = app_settings.trace_enabled
+        self.slow_request = app_settings.trace_slow_request
+        self.profiler = app_settings.trace_profiler
+        self.profile_sample_rate = app_settings.trace_profile_sample_rate
+        # A single profiler can run in a thread
+        self.profiling = False
+        self._next_check = 0.0
+        self._file_state: tuple | None = None
+
+    def refresh(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + CONTROL_CHECK_INTERVAL
+        path = app_settings.trace_control_file
+        try:
+            file_state = (path, os.stat(path).st_mtime_ns)
+        except OSError:
+            file_state = (path, None)
+        if file_state != self._file_state:
+            self._file_state = file_state
+            self.reload()
+
+    def reload(self) -> None:
+        settings: dict[str, Any] = {}
+        try:
+            settings = json.loads(app_settings.trace_control_file.read_bytes())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.error(f'Tracing control file {app_settings.trace_control_file}: {e}')
+        self.enabled = bool(settings.get('enabled', app_settings.trace_enabled))
+        self.slow_request = float(settings.get('slow_request', app_settings.trace_slow_request))
+        self.profiler = settings.get('profiler', app_settings.trace_profiler)
+        if self.profiler not in PROFILERS:
+            logging.error(f'Tracing control file: unknown profiler {self.profiler}')
+            self.profiler = 'none'
+        self.profile_sample_rate = float(settings.get('profile_sample_rate', app_settings.trace_profile_sample_rate))
+
+
+tracing_control = TracingControl()
+
+
+class Profiler:
+    """cProfile or pyinstrument (optional dependency) around a request. cProfile sees the whole thread:
+    the other requests served at the same time are in its profile too"""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        if kind == 'pyinstrument':
+            from pyinstrument import Profiler as PyinstrumentProfiler
+
+            self._profiler = PyinstrumentProfiler(async_mode='enabled')
+        else:
+            self._profiler = cProfile.Profile()
+
+    def start(self) -> None:
+        if self.kind == 'pyinstrument':
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self) -> None:
+        if self.kind == 'pyinstrument':
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+
+    def format(self) -> str:
+        if self.kind == 'pyinstrument':
+            return self._profiler.output_text(unicode=False)
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        return stream.getvalue()
+
+
+def _start_profiler() -> Profiler | None:
+    control = tracing_control
+    if control.profiler == 'none' or control.profiling or random.random() >= control.profile_sample_rate:
+        return None
+    try:
+        profiler = Profiler(control.profiler)
+        profiler.start()
+    except (ImportError, ValueError) as e:
+        logging.error(f'Request profiling with {control.profiler}: {e}')
+        return None
+    control.profiling = True
+    return profiler
+
+
+def _write_profile(report: str, profiler: Profiler) -> str:
+    app_settings.trace_dir.mkdir(parents=True, exist_ok=True)
+    path = app_settings.trace_dir / f'{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}.txt'
+    path.write_text(f'{report}\n\n{profiler.format()}')
+    return str(path)
+
+
+class TracingMiddleware:
+    """Traces the requests while the tracing is on: the spans of the requests slower than slow_request
+    are logged, with the profile of the sampled ones (written to trace_dir)"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        tracing_control.refresh()
+        if not tracing_control.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_traced(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        trace = Trace()
+        token = _current_trace.set(trace)
+        profiler = _start_profiler()
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                tracing_control.profiling = False
+            _current_trace.reset(token)
+            duration = time.perf_counter() - trace.start
+            if duration >= tracing_control.slow_request:
+                await self._report(scope, status_code, duration, trace, profiler)
+
+    @staticmethod
+    async def _report(scope: Scope, status_code: int, duration: float, trace: Trace,
+                      profiler: Profiler | None) -> None:
+        route = scope.get('route')
+        path = route.path if route is not None else scope['path']
+        report = trace.format(f'Slow request {scope["method"]} {path} {status_code}: {duration * 1000:.2f} ms')
+        if profiler is not None:
+            try:
+                report += f'\nProfile: {await asyncio.to_thread(_write_profile, report, profiler)}'
+            except OSError as e:
+                logging.error(f'Request profile not written: {e}')
+        logging.warning(report)
@@ -0,0 +1,360 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import shutil
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+from typing import Any, AsyncIterator, NamedTuple, Type
+from uuid import UUID
+
+from aiopath import AsyncPath
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from src.core.config import app_settings
+from src.exceptions import (UploadNotFoundException, UploadConflictException, UploadTooLargeException,
+                            ValidationException)
+from src.models.file_model import File as FileModel
+from src.models.upload_model import UploadSession as UploadSessionModel
+from src.schemas.upload_schema import UploadSessionCreate, UploadSessionID, UploadPartIn
+from src.schemas.user_schema import UserInDB
+from src.services.base_service import SQLAlchemyRepository, Repository
+from src.services.file_service import file_service
+from src.services.storage import STAGING_DIR
+from src.services.utils import (as_utc, create_dir_if_not_exists, remove_file, replace_file, write_at, get_temp_path,
+                                concatenate_files)
+
+TUS_VERSION = '1.0.0'
+RESUMABLE = 'resumable'
+MULTIPART = 'multipart'
+MAX_PARTS = 10_000
+# Expired sessions removed in one statement
+CLEANUP_BATCH_SIZE = 1000
+# Seconds between the attempts to lock a part being replaced by another request
+PART_LOCK_RETRY_DELAY = 0.01
+
+
+class UploadState(NamedTuple):
+    upload_session: UploadSessionModel
+    # Bytes received so far
+    offset: int
+    # The file created when the last byte is received
+    file: FileModel | None = None
+
+
+class UploadPart(NamedTuple):
+    part_number: int
+    size: int
+    sha256: str
+    path: AsyncPath
+
+
+def get_staging_path(upload_id: UUID) -> AsyncPath:
+    """The uploaded bytes are kept in storage_path, so the finished upload is moved into the storage without a copy"""
+
+    return AsyncPath(app_settings.storage_path, STAGING_DIR, 'uploads', upload_id.hex)
+
+
+def get_parts_path(upload_id: UUID) -> AsyncPath:
+    """Directory of the parts of a multipart upload: the files are named '<part number>.<sha256>'"""
+
+    return AsyncPath(app_settings.storage_path, STAGING_DIR, 'uploads', f'{upload_id.hex}.parts')
+
+
+def _scan_parts(parts_path: str) -> list[UploadPart]:
+    try:
+        entries = list(os.scandir(parts_path))
+    except FileNotFoundError:
+        return []
+    parts = []
+    for entry in entries:
+        # Parts being received are temp files
+        if not entry.name.startswith('.'):
+            part_number, _, sha256 = entry.name.partition('.')
+            parts.append(UploadPart(int(part_number), entry.stat().st_size, sha256, AsyncPath(entry.path)))
+    return sorted(parts)
+
+
+def _lock(fd: int, reason: str, operation: int = fcntl.LOCK_EX) -> None:
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise UploadConflictException(reason)
+
+
+async def _open_parts(parts_path: AsyncPath) -> int:
+    """The directory of the parts is locked for the writes of the parts and the completion"""
+
+    try:
+        return await asyncio.to_thread(os.open, parts_path, os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+        raise UploadNotFoundException
+
+
+class UploadSessionRepository(SQLAlchemyRepository):
+    model = UploadSessionModel
+
+    async def touch(self, db: AsyncSession, upload_session: UploadSessionModel) -> None:
+        """The new updated_at comes back with the update: no query after the commit, which would begin
+        a transaction holding the connection while the request body is received"""
+
+        stmt = (update(self.model)
+                .where(self.model.id == upload_session.id)
+                .values(updated_at=func.now())
+                .returning(self.model.updated_at))
+        updated_at = (await db.execute(stmt)).scalar_one()
+        await db.commit()
+        set_committed_value(upload_session, 'updated_at', updated_at)
+
+    async def delete_expired(self, db: AsyncSession, ttl: timedelta, limit: int) -> list[UUID]:
+        expired = (select(self.model.id)
+                   .where(self.model.updated_at < func.now() - ttl)
+                   .limit(limit)
+                   .with_for_update(skip_locked=True))
+        stmt = delete(self.model).where(self.model.id.in_(expired)).returning(self.model.id)
+        results = await db.execute(statement=stmt)
+        return list(results.scalars())
+
+
+class UploadService:
+    """Resumable uploads (tus-style): the session is created with the length of the file, the content is sent
+    by PATCH requests at the offset the server has, the file is saved when the last byte is received.
+    Multipart uploads: the numbered parts are sent in parallel (to any worker), joined on completion"""
+
+    def __init__(self, repo: Type[Repository]):
+        self.repo = repo()
+
+    async def create_upload(self, db: AsyncSession, user: UserInDB, filename: str, path_dir: str | None,
+                            length: int) -> UploadState:
+        if length > app_settings.upload_max_size:
+            raise UploadTooLargeException(app_settings.upload_max_size)
+        obj_in = UploadSessionCreate(name=filename, path_dir=path_dir or '', length=length, user_id=user.id)
+        upload_session = await self.repo.create(db=db, obj_in=obj_in)
+        staging_path = get_staging_path(upload_session.id)
+        await create_dir_if_not_exists(staging_path)
+        await staging_path.touch()
+        return UploadState(upload_session=upload_session, offset=0)
+
+    async def create_multipart_upload(self, db: AsyncSession, user: UserInDB, filename: str,
+                                      path_dir: str | None) -> UploadState:
+        obj_in = UploadSessionCreate(name=filename, path_dir=path_dir or '', kind=MULTIPART, length=None,
+                                     user_id=user.id)
+        upload_session = await self.repo.create(db=db, obj_in=obj_in)
+        await get_parts_path(upload_session.id).mkdir(parents=True, exist_ok=True)
+        return UploadState(upload_session=upload_session, offset=0)
+
+    async def _get_session(self, db: AsyncSession, user: UserInDB, upload_id: UUID,
+                           kind: str | None = None) -> UploadSessionModel:
+        upload_session = await self.repo.get(db=db, db_obj=UploadSessionID(id=upload_id))
+        if upload_session is None or upload_session.user_id != user.id or kind not in (None, upload_session.kind):
+            raise UploadNotFoundException
+        return upload_session
+
+    async def get_upload(self, db: AsyncSession, user: UserInDB, upload_id: UUID) -> UploadState:
+        upload_session = await self._get_session(db, user, upload_id, RESUMABLE)
+        try:
+            # The staging file is the only record of the received bytes
+            offset = (await get_staging_path(upload_id).stat()).st_size
+        except FileNotFoundError:
+            raise UploadNotFoundException
+        return UploadState(upload_session=upload_session, offset=offset)
+
+    async def write_upload(self, db: AsyncSession, user: UserInDB, upload_id: UUID, offset: int,
+                           chunks: AsyncIterator[bytes]) -> UploadState:
+        """Write the request body at the offset. One request at a time writes the upload (409 for the others)"""
+
+        upload_session = (await self.get_upload(db, user, upload_id)).upload_session
+        # The connection goes back to the pool while the body is being received
+        await db.commit()
+        staging_path = get_staging_path(upload_id)
+        fd = await asyncio.to_thread(os.open, staging_path, os.O_WRONLY)
+        try:
+            _lock(fd, 'Upload is being written by another request')
+            current_offset = os.fstat(fd).st_size
+            if offset != current_offset:
+                raise UploadConflictException(f'Upload-Offset is {current_offset}')
+            offset = await self._write_chunks(fd, offset, upload_session.length, chunks)
+            if offset < upload_session.length:
+                await self.repo.touch(db, upload_session)
+                return UploadState(upload_session=upload_session, offset=offset)
+            file_model_obj = await self._store_file(db, user, upload_session, staging_path)
+        finally:
+            await asyncio.to_thread(os.close, fd)
+        await self._remove_staging(upload_id)
+        return UploadState(upload_session=upload_session, offset=offset, file=file_model_obj)
+
+    async def write_part(self, db: AsyncSession, user: UserInDB, upload_id: UUID, part_number: int,
+                         chunks: AsyncIterator[bytes], sha256: str | None = None) -> UploadPart:
+        """Stage the part of a multipart upload, its checksum is checked if the client sent it.
+        A part sent again replaces the previous one"""
+
+        upload_session = await self._get_session(db, user, upload_id, MULTIPART)
+        # Extends the session, the connection goes back to the pool while the part is being received
+        await self.repo.touch(db, upload_session)
+        parts_path = get_parts_path(upload_id)
+        parts_fd = await _open_parts(parts_path)
+        try:
+            # Parts are written in parallel (shared lock), the completion (exclusive lock) is refused meanwhile
+            _lock(parts_fd, 'Upload is being completed', fcntl.LOCK_SH)
+            return await self._write_part(parts_path, part_number, chunks, sha256)
+        finally:
+            await asyncio.to_thread(os.close, parts_fd)
+
+    async def _write_part(self, parts_path: AsyncPath, part_number: int, chunks: AsyncIterator[bytes],
+                          sha256: str | None) -> UploadPart:
+        temp_path = get_temp_path(AsyncPath(parts_path, str(part_number)))
+        checksum = hashlib.sha256()
+        try:
+            fd = await asyncio.to_thread(os.open, temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileNotFoundError:
+            raise UploadNotFoundException
+        try:
+            try:
+                size = await self._write_chunks(fd, 0, app_settings.upload_max_size, chunks, checksum)
+            finally:
+                await asyncio.to_thread(os.close, fd)
+            if sha256 is not None and sha256.lower() != checksum.hexdigest():
+                raise ValidationException('part checksum')
+            part = UploadPart(part_number, size, checksum.hexdigest(),
+                              AsyncPath(parts_path, f'{part_number}.{checksum.hexdigest()}'))
+            await self._replace_part(parts_path, temp_path, part)
+        except BaseException:
+            await remove_file(temp_path)
+            raise
+        return part
+
+    @staticmethod
+    async def _replace_part(parts_path: AsyncPath, temp_path: AsyncPath, part: UploadPart) -> None:
+        """Put the part in place of the one with the same number. The requests sending the same part
+        replace it one at a time (the last one is kept), so none removes the part another has just put"""
+
+        lock_fd = await asyncio.to_thread(os.open, AsyncPath(parts_path, f'.{part.part_number}.lock'),
+                                          os.O_WRONLY | os.O_CREAT)
+        try:
+            while True:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(PART_LOCK_RETRY_DELAY)
+            await replace_file(temp_path, part.path)
+            for staged_part in await asyncio.to_thread(_scan_parts, str(parts_path)):
+                if staged_part.part_number == part.part_number and staged_part.path != part.path:
+                    await remove_file(staged_part.path)
+        finally:
+            await asyncio.to_thread(os.close, lock_fd)
+
+    async def get_parts(self, db: AsyncSession, user: UserInDB, upload_id: UUID) -> list[UploadPart]:
+        await self._get_session(db, user, upload_id, MULTIPART)
+        return await asyncio.to_thread(_scan_parts, str(get_parts_path(upload_id)))
+
+    async def complete_multipart_upload(self, db: AsyncSession, user: UserInDB, upload_id: UUID,
+                                        parts: list[UploadPartIn]) -> UploadState:
+        """Join the listed parts (in ascending order, checksums as returned for them) into the file"""
+
+        upload_session = await self._get_session(db, user, upload_id, MULTIPART)
+        await db.commit()
+        part_numbers = [part.part_number for part in parts]
+        if part_numbers != sorted(set(part_numbers)):
+            raise ValidationException('part order')
+        parts_path = get_parts_path(upload_id)
+        parts_fd = await _open_parts(parts_path)
+        try:
+            # No part is replaced (or removed) while the parts are being joined
+            _lock(parts_fd, 'Upload is being written or completed by another request')
+            staged_parts = {part.part_number: part for part in await asyncio.to_thread(_scan_parts, str(parts_path))}
+            for part in parts:
+                if (part.part_number not in staged_parts
+                        or staged_parts[part.part_number].sha256 != part.sha256.lower()):
+                    raise ValidationException(f'part {part.part_number}')
+            if sum(staged_parts[part_number].size for part_number in part_numbers) > app_settings.upload_max_size:
+                raise UploadTooLargeException(app_settings.upload_max_size)
+
+            staging_path = get_staging_path(upload_id)
+            size = await asyncio.to_thread(concatenate_files,
+                                           [str(staged_parts[part_number].path) for part_number in part_numbers],
+                                           str(staging_path))
+            file_model_obj = await self._store_file(db, user, upload_session, staging_path)
+        finally:
+            await asyncio.to_thread(os.close, parts_fd)
+        await self._remove_staging(upload_id)
+        return UploadState(upload_session=upload_session, offset=size, file=file_model_obj)
+
+    async def _store_file(self, db: AsyncSession, user: UserInDB, upload_session: UploadSessionModel,
+                          staging_path: AsyncPath) -> FileModel:
+        file_model_obj = await file_service.store_file(db, user, upload_session.name, upload_session.path_dir,
+                                                       lambda storage, key: storage.stage_file(staging_path, key))
+        await self.repo.delete(db=db, db_obj=upload_session)
+        return file_model_obj
+
+    @staticmethod
+    async def _write_chunks(fd: int, offset: int, max_offset: int, chunks: AsyncIterator[bytes],
+                            checksum: Any = None) -> int:
+        buffer = bytearray()
+        try:
+            async for chunk in chunks:
+                if offset + len(buffer) + len(chunk) > max_offset:
+                    raise UploadTooLargeException(max_offset)
+                if checksum is not None:
+                    checksum.update(chunk)
+                buffer += chunk
+                if len(buffer) >= app_settings.upload_chunk_size:
+                    offset += await asyncio.to_thread(write_at, fd, bytes(buffer), offset)
+                    buffer.clear()
+        finally:
+            # The bytes received before an error or a disconnect are kept: the client resumes after them
+            if buffer:
+                offset += await asyncio.to_thread(write_at, fd, bytes(buffer), offset)
+            if app_settings.upload_durability != 'none':
+                await asyncio.to_thread(os.fsync, fd)
+        return offset
+
+    async def delete_upload(self, db: AsyncSession, user: UserInDB, upload_id: UUID) -> None:
+        upload_session = await self._get_session(db, user, upload_id)
+        await self.repo.delete(db=db, db_obj=upload_session)
+        await self._remove_staging(upload_id)
+
+    @staticmethod
+    async def _remove_staging(upload_id: UUID) -> None:
+        await remove_file(get_staging_path(upload_id))
+        await asyncio.to_thread(shutil.rmtree, get_parts_path(upload_id), ignore_errors=True)
+
+    async def remove_expired(self, db: AsyncSession) -> int:
+        """Remove the sessions not written for upload_session_ttl seconds, returns their number"""
+
+        ttl = timedelta(seconds=app_settings.upload_session_ttl)
+        removed = 0
+        while True:
+            upload_ids = await self.repo.delete_expired(db, ttl, CLEANUP_BATCH_SIZE)
+            await db.commit()
+            for upload_id in upload_ids:
+                await self._remove_staging(upload_id)
+            removed += len(upload_ids)
+            if len(upload_ids) < CLEANUP_BATCH_SIZE:
+                return removed
+
+    @staticmethod
+    def get_expires_at(upload_session: UploadSessionModel) -> datetime:
+        return as_utc(upload_session.updated_at) + timedelta(seconds=app_settings.upload_session_ttl)
+
+    def get_headers(self, upload_state: UploadState) -> dict[str, str]:
+        return {'Tus-Resumable': TUS_VERSION,
+                'Upload-Offset': str(upload_state.offset),
+                'Upload-Length': str(upload_state.upload_session.length),
+                'Upload-Expires': format_datetime(self.get_expires_at(upload_state.upload_session), usegmt=True),
+                'Cache-Control': 'no-store'}
+
+    def get_info(self, upload_state: UploadState) -> dict:
+        upload_session = upload_state.upload_session
+        return {'id': upload_session.id,
+                'name': upload_session.name,
+                'path_dir': upload_session.path_dir,
+                'kind': upload_session.kind,
+                'length': upload_session.length,
+                'offset': upload_state.offset,
+                'expires_at': self.get_expires_at(upload_session)}
+
+
+upload_service = UploadService(UploadSessionRepository)
@@ -7,8 +7,10 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.core.config import app_settings
 from src.models.user_model import User as UserModel
-from src.schemas.user_schema import UserIn, UserInDB, Username
+from src.schemas.user_schema import UserIn, UserInDB, Username, UserCached, UserActivity
 from src.services.base_service import SQLAlchemyRepository, Repository
+from src.services.cache import TTLCache
+from src.services.tracing import traced
 from src.services.utils import create_hashed_password, check_password
 
 
@@ -19,13 +21,18 @@ class UserRepository(SQLAlchemyRepository):
 class UserService:
     def __init__(self, repo: Type[Repository]):
         self.repo = repo()
+        self.cache: TTLCache[str, UserCached] = TTLCache('user', app_settings.user_cache_size,
+                                                         app_settings.user_cache_ttl)
 
+    @traced
     async def create_user_in_db(self, db: AsyncSession, user: UserIn) -> UserModel:
         hashed_password = await create_hashed_password(user.password)
         user_in_db = UserInDB(**user.model_dump(), hashed_password=hashed_password)
         new_user = await self.repo.create(db=db, obj_in=user_in_db)
+        self.invalidate_user(new_user.username)
         return new_user
 
+    @traced
     async def authenticate_user(self, db: AsyncSession, form_data: OAuth2PasswordRequestForm) -> UserModel | None:
         username_obj = Username(username=form_data.username)
         user = await self.repo.get(db=db, db_obj=username_obj)
@@ -33,6 +40,7 @@ class UserService:
             return None
         return user
 
+    @traced
     async def get_token(self, username: str) -> dict:
         access_token_expires = timedelta(minutes=app_settings.token_expire_minutes)
         access_token = await self._create_access_token(
@@ -41,6 +49,7 @@ class UserService:
         )
         return {"access_token": access_token, "token_type": "bearer"}
 
+    @traced
     async def _create_access_token(self, data: dict, expires_delta: timedelta) -> str:
         to_encode = data.copy()
         expire = datetime.utcnow() + expires_delta
@@ -48,9 +57,37 @@ class UserService:
         encoded_jwt = jwt.encode(to_encode, app_settings.token_secret_key, algorithm=app_settings.token_jwt_algorithm)
         return encoded_jwt
 
+    @traced
     async def get_user(self, db: AsyncSession, username: Username) -> UserModel:
         user = await self.repo.get(db=db, db_obj=username)
         return user
 
+    @traced
+    async def get_cached_user(self, db: AsyncSession, username: Username) -> UserCached | None:
+        """User from the cache, the database is queried on a miss only"""
+
+        user = self.cache.get(username.username)
+        if user is None:
+            user_model = await self.get_user(db=db, username=username)
+            if user_model is None:
+                return None
+            user = UserCached.model_validate(user_model)
+            self.cache.set(username.username, user)
+        return user
+
+    @traced
+    async def set_user_activity(self, db: AsyncSession, username: Username, is_active: bool) -> UserModel | None:
+        user = await self.get_user(db=db, username=username)
+        if user is None:
+            return None
+        user = await self.repo.update(db=db, db_obj=user, obj_in=UserActivity(is_active=is_active))
+        self.invalidate_user(username.username)
+        return user
+
+    def invalidate_user(self, username: str) -> None:
+        """Has to be called on every change of the user: the cached copy is used for authentication"""
+
+        self.cache.invalidate(username)
+
 
 user_service = UserService(UserRepository)
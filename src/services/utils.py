@@ -1,20 +1,78 @@
+import asyncio
+import base64
+import csv
+import errno
+import hashlib
+import io
+import os
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import NamedTuple, Callable, TypeVar, AsyncIterator, Mapping
+from urllib.parse import quote
+from uuid import uuid4
 
 import bcrypt
+import orjson
+from aiofile import AIOFile
 from aiopath import AsyncPath
 from fastapi import UploadFile
 
 from src.core.config import app_settings
+from src.exceptions import ServiceOverloadedException, ValidationException
+from src.services.metrics import FILE_IO_DURATION, PASSWORD_HASH_DURATION
+from src.services.tracing import Span, traced
 
+T = TypeVar('T')
 
+# Directory of the deduplicated storage in storage_path
+BLOBS_DIR = '.blobs'
+
+
+class PasswordHashExecutor:
+    """Runs bcrypt off the event loop in a bounded thread pool"""
+
+    def __init__(self):
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending = 0
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        if self._pending >= app_settings.password_hash_workers + app_settings.password_hash_queue_size:
+            raise ServiceOverloadedException
+        if self._executor is None:
+            # Created on the first call: the threads must not be started before the worker process is forked
+            self._executor = ThreadPoolExecutor(max_workers=app_settings.password_hash_workers,
+                                                thread_name_prefix='password-hash')
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, _timed_hash, func, *args)
+        finally:
+            self._pending -= 1
+
+
+def _timed_hash(func: Callable[..., T], *args) -> T:
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        PASSWORD_HASH_DURATION.labels(func.__name__).observe(time.perf_counter() - start)
+
+
+password_hash_executor = PasswordHashExecutor()
+
+
+@traced
 async def create_hashed_password(password: str) -> str:
-    hashed_password_b: bytes = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    salt = bcrypt.gensalt(rounds=app_settings.password_hash_rounds)
+    hashed_password_b: bytes = await password_hash_executor.run(bcrypt.hashpw, password.encode('utf-8'), salt)
     hashed_password: str = hashed_password_b.decode('utf-8')
     return hashed_password
 
 
+@traced
 async def check_password(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+    return await password_hash_executor.run(bcrypt.checkpw, password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 
 def form_message(*, info: str, status: str, service: str | None = None) -> dict:
@@ -27,39 +85,225 @@ async def create_dir_if_not_exists(path: AsyncPath) -> None:
     await path.parent.mkdir(parents=True, exist_ok=True)
 
 
-async def get_absolute_file_path(username: str, filename: str, path_dir: str | None) -> AsyncPath:
-    storage_path = app_settings.storage_path
+def get_content_disposition(filename: str) -> str:
+    """attachment header value as FileResponse builds it: the names beyond ASCII (or with quotes) go percent-encoded
+    in filename* (headers are latin-1)"""
+
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
+
+def as_utc(value: datetime) -> datetime:
+    """Aware datetime in UTC. Timestamps are stored without a timezone in UTC: naive values are taken as UTC,
+    as_utc(value).replace(tzinfo=None) is the stored form of an aware one"""
+
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def get_file_key(username: str, filename: str, path_dir: str | None) -> str:
+    """Storage key of the file stored by its path: username/path_dir/filename"""
+
     if path_dir:
-        file_path = AsyncPath(storage_path, username, path_dir, filename)
-    else:
-        file_path = AsyncPath(storage_path, username, filename)
-    return file_path
+        return f'{username}/{path_dir}/{filename}'
+    return f'{username}/{filename}'
+
+
+def get_blob_key(blob_hash: str) -> str:
+    """Content-addressed storage key of the blob: .blobs/ab/cd/abcd..."""
+
+    return f'{BLOBS_DIR}/{blob_hash[:2]}/{blob_hash[2:4]}/{blob_hash}'
+
+
+class WrittenFile(NamedTuple):
+    size: int
+    checksum: str
+    temp_path: AsyncPath
+
+
+class FileUpload(NamedTuple):
+    path_dir: str
+    filename: str
+    file: UploadFile
+
+
+def _fsync(path: str, flags: int = os.O_RDONLY) -> None:
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_temp_path(file_path: AsyncPath) -> AsyncPath:
+    return file_path.with_name(f'.{file_path.name}.{uuid4().hex}.tmp')
+
 
+def link_file(source_path: str, link_path: str) -> tuple[int, str]:
+    """Hard link (no copy) of the complete file, returns its size and sha256"""
 
-async def write_file(file: UploadFile, file_path: AsyncPath, is_file_path_exists: bool):
-    if not is_file_path_exists:
-        await create_dir_if_not_exists(file_path)
-    async with file_path.open(mode='wb') as f:
-        content = await file.read()
-        await f.write(content)
+    os.link(source_path, link_path)
+    checksum = hashlib.sha256()
+    with open(link_path, 'rb') as f:
+        while chunk := f.read(app_settings.upload_chunk_size):
+            checksum.update(chunk)
+        return f.tell(), checksum.hexdigest()
 
 
-async def file_chunk_generator(file_path: AsyncPath):
-    with open(file_path, "rb") as f:
-        while True:
-            chunk = f.read(200 * 1024)
-            if not chunk:
-                break
-            yield chunk
+def write_at(fd: int, data: bytes, offset: int) -> int:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view, offset = view[written:], offset + written
+    return len(data)
+
+
+def concatenate_files(source_paths: list[str], target_path: str) -> int:
+    """Join the files with copy_file_range: the data does not pass through the user space
+    (and may be reflinked by the file system). Returns the size of the target"""
+
+    with open(target_path, 'wb') as target:
+        for source_path in source_paths:
+            with open(source_path, 'rb') as source:
+                _copy_file(source.fileno(), target.fileno(), os.fstat(source.fileno()).st_size)
+        return os.fstat(target.fileno()).st_size
+
+
+def _copy_file(source_fd: int, target_fd: int, size: int) -> None:
+    try:
+        while size and (copied := os.copy_file_range(source_fd, target_fd, size)):
+            size -= copied
+    except OSError as e:
+        # Not supported between these file systems: sendfile continues from the current offsets
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+    while size and (copied := os.sendfile(target_fd, source_fd, None, size)):
+        size -= copied
+
+
+@traced
+async def write_temp_file(file: UploadFile, file_path: AsyncPath) -> WrittenFile:
+    """Stream the upload to a temp file next to file_path, counting its size and sha256 in the same pass.
+    The temp file has to be moved into place with replace_file (or dropped with remove_file)"""
+
+    await create_dir_if_not_exists(file_path)
+    temp_path = get_temp_path(file_path)
+    size = 0
+    checksum = hashlib.sha256()
+    # Time of the writes only (not of waiting for the upload)
+    write_time = 0.0
+    try:
+        async with temp_path.open(mode='wb') as f:
+            while chunk := await file.read(app_settings.upload_chunk_size):
+                checksum.update(chunk)
+                start = time.perf_counter()
+                await f.write(chunk)
+                write_time += time.perf_counter() - start
+                size += len(chunk)
+        FILE_IO_DURATION.labels('write').observe(write_time)
+        if app_settings.upload_durability != 'none':
+            start = time.perf_counter()
+            await asyncio.to_thread(_fsync, str(temp_path))
+            FILE_IO_DURATION.labels('fsync').observe(time.perf_counter() - start)
+    except BaseException:
+        await remove_file(temp_path)
+        raise
+    return WrittenFile(size=size, checksum=checksum.hexdigest(), temp_path=temp_path)
+
+
+@traced
+async def replace_file(temp_path: AsyncPath, file_path: AsyncPath) -> None:
+    """Atomically put temp_path in place of file_path: readers see either the old or the new file"""
+
+    await asyncio.to_thread(os.replace, temp_path, file_path)
+    if app_settings.upload_durability == 'full':
+        await asyncio.to_thread(_fsync, str(file_path.parent), os.O_RDONLY | os.O_DIRECTORY)
+
+
+async def remove_file(file_path: AsyncPath) -> None:
+    await file_path.unlink(missing_ok=True)
+
+
+async def file_chunk_generator(file_path: AsyncPath, offset: int = 0, length: int | None = None):
+    """Read the file from offset: length bytes or up to the end.
+    Reads go through aiofile (caio), the next download_read_ahead chunks are read while the current one is sent"""
+
+    chunk_size = app_settings.download_chunk_size
+    reads: deque[asyncio.Future] = deque()
+    # Time the download waited for the reads (the ones done ahead don't count)
+    read_time = 0.0
+    async with AIOFile(str(file_path), 'rb') as f:
+        if length is None:
+            length = os.fstat(f.fileno()).st_size - offset
+        position, end = offset, offset + length
+        try:
+            while reads or position < end:
+                while position < end and len(reads) <= app_settings.download_read_ahead:
+                    size = min(chunk_size, end - position)
+                    reads.append(asyncio.ensure_future(f.read_bytes(size, position)))
+                    position += size
+                start = time.perf_counter()
+                chunk = await reads.popleft()
+                read_time += time.perf_counter() - start
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            for read in reads:
+                read.cancel()
+            FILE_IO_DURATION.labels('read').observe(read_time)
+
+
+async def ndjson_batch_generator(batches: AsyncIterator[list[Mapping]]) -> AsyncIterator[bytes]:
+    """One chunk of newline-delimited JSON per batch of rows"""
+
+    async for rows in batches:
+        # default: the types orjson doesn't know (like the asyncpg UUID) are written as strings
+        yield b''.join(orjson.dumps(dict(row), default=str, option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+
+
+async def csv_batch_generator(batches: AsyncIterator[list[Mapping]], columns: list[str]) -> AsyncIterator[bytes]:
+    """Header and then one chunk of CSV per batch of rows"""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    yield buffer.getvalue().encode('utf-8')
+    async for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode('ascii')
+
+
+def decode_cursor(cursor: str, length: int) -> list:
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeEncodeError):
+        raise ValidationException('cursor')
+    # The values are JSON scalars (as encoded), their types are checked against the columns by the repository
+    if (not isinstance(values, list) or len(values) != length
+            or not all(isinstance(value, (str, int)) and not isinstance(value, bool) for value in values)):
+        raise ValidationException('cursor')
+    return values
 
 
 def execution_time(func):
+    """(result, duration) of the coroutine function, the call is a span of the traced request"""
+
+    name = func.__qualname__
+
     async def wrapper(*args, **kwargs):
-        start_time = time.perf_counter()
-        result = await func(*args, **kwargs)
-        end_time = time.perf_counter()
-        execution_time = end_time - start_time
-        return result, execution_time
+        with Span(name) as span:
+            result = await func(*args, **kwargs)
+        return result, span.duration
 
     return wrapper
 
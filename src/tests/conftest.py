@@ -23,6 +23,7 @@ from src.main import app
 from src.models.base import Base
 from src.models.file_model import File as FileModel
 from src.models.user_model import User as UserModel
+from src.services.loop_monitor import LoopMonitor
 from .settings import test_settings
 
 
@@ -39,6 +40,20 @@ def event_loop():
     loop.close()
 
 
+@pytest.fixture(autouse=True)
+async def strict_loop_monitor(request: pytest.FixtureRequest) -> AsyncGenerator[None, None]:
+    """LOOP_MONITOR_STRICT_MS=100 pytest: the tests blocking the event loop longer fail"""
+    if not app_settings.loop_monitor_strict_ms or request.node.get_closest_marker('blocks_loop'):
+        yield
+        return
+    threshold = app_settings.loop_monitor_strict_ms / 1000
+    monitor = LoopMonitor(interval=threshold / 2, threshold=threshold, strict=True)
+    monitor.start()
+    yield
+    await monitor.stop()
+    monitor.check()
+
+
 @pytest.fixture(scope='session')
 async def ac() -> AsyncGenerator[AsyncClient, None]:
     base_url = TEST_URL
@@ -11,7 +11,7 @@ alembic upgrade head
 cd ..
 
 echo 'Starting app'
-gunicorn -k uvicorn.workers.UvicornWorker -w 1 -b 0.0.0.0:8080 src.main:app
+exec gunicorn -c src/core/gunicorn_conf.py src.main:app
 
 
 